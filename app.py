@@ -1,3 +1,4 @@
+import os
 import boto3
 import json
 import pandas as pd
@@ -12,15 +13,34 @@ from dash_bootstrap_templates import load_figure_template
 from dash import Dash, dcc, html, Input, Output, callback, dash_table
 from plotly.subplots import make_subplots
 
-def plot_alltime_data(option):
+from table_store import PartitionedTables, pivot_long
+
+#Charts with tables in the bucket (see pull_data/charts.py). Each table is stored as weekly partitions
+#(see table_store.py) and only loaded the first time a plot for that chart needs it. Partitions are cached
+#on local disk by ETag, so after a restart only the manifests are checked with S3
+CHARTS = {'hot-100': 'Billboard Hot 100', 'billboard-200': 'Billboard 200'}
+DEFAULT_CHART = 'hot-100'
+DASHBOARD_CHARTS = os.environ.get('DASHBOARD_CHARTS', DEFAULT_CHART).split(',')
+stores = {}
+tables = {}
+
+def load_table(table, chart):
+    if (table, chart) not in tables:
+        if chart not in stores:
+            stores[chart] = PartitionedTables(chart, s3=s3)
+        tables[(table, chart)] = stores[chart].read(table)
+    return tables[(table, chart)]
+
+def plot_alltime_data(option, chart=DEFAULT_CHART):
     if (option == "Artist Popularity"):
+        df_artist_pop = load_table('df_artist_pop', chart)
         alltimefig = go.Figure()
 
         #Drop low-popularity artists to clean up plotting
-        for series_name, series in df_artist_pop.items():
-            if (series_name != 'date'):
-                if (max(series) > 90) and (series.sum() > 2000):
-                    alltimefig.add_trace(go.Scatter(x=df_artist_pop['date'], y=series, mode='lines+markers', name=series_name))
+        stats = df_artist_pop.groupby('key', sort=False)['value'].agg(['max', 'sum'])
+        df_plot = pivot_long(df_artist_pop, stats[(stats['max'] > 90) & (stats['sum'] > 2000)].index)
+        for series_name, series in df_plot.items():
+            alltimefig.add_trace(go.Scatter(x=df_plot.index, y=series, mode='lines+markers', name=series_name))
         alltimefig.update_layout(yaxis_title='Chart Popularity Score')
         alltimefig.add_annotation(text='Double click on an item in the legend to isolate it!', 
         align='right',
@@ -31,6 +51,7 @@ def plot_alltime_data(option):
         y=1.1,
         borderwidth=1)
     elif (option == "Emotions"):
+        df_emotion = load_table('df_emotion', chart)
         alltimefig = make_subplots(rows=2, cols=1, shared_xaxes=True)
         alltimefig.append_trace(go.Scatter(x=df_emotion['date'], y=np.zeros_like(df_emotion['positive']), mode='lines', visible=False, showlegend=False),1,1)
         alltimefig.append_trace(go.Scatter(x=df_emotion['date'], y=df_emotion['positive'] - df_emotion['negative'], mode='lines', fill='tonexty', name='', showlegend=False),1,1)
@@ -49,13 +70,15 @@ def plot_alltime_data(option):
                     y=1.1,
                     borderwidth=1)
     elif (option == "Word Frequency"):
+        df_word_freq = load_table('df_word_freq', chart)
         alltimefig = make_subplots()
 
         #Drop low-popularity artists to clean up plotting
-        for series_name, series in df_word_freq.items():
-            if (series_name != 'date'):
-                if (max(series) > 0.004) or (series > 0.001).all():
-                    alltimefig.add_trace(go.Scatter(x=df_word_freq['date'], y=series, mode='lines', name=series_name))
+        stats = df_word_freq.groupby('key', sort=False)['value'].agg(['max', lambda series: (series > 0.001).sum()])
+        stats.columns = ['max', 'n_common']
+        df_plot = pivot_long(df_word_freq, stats[(stats['max'] > 0.004) | (stats['n_common'] == df_word_freq['date'].nunique())].index)
+        for series_name, series in df_plot.items():
+            alltimefig.add_trace(go.Scatter(x=df_plot.index, y=series, mode='lines', name=series_name))
         alltimefig.update_layout(yaxis_title='Word Frequency')
         alltimefig.add_annotation(text='Double click on an item in the legend to isolate it!', 
             align='right',
@@ -66,6 +89,7 @@ def plot_alltime_data(option):
             y=1.1,
             borderwidth=1)
     elif (option == "Song Duration"):
+        df = load_table('df_final', chart)
         alltimefig = go.Figure([
         go.Scatter(
             x=df['date'],
@@ -99,6 +123,7 @@ def plot_alltime_data(option):
             showlegend=False
         )
     elif (option == "Weeks on Chart"):
+        df = load_table('df_final', chart)
         alltimefig = go.Figure([
         go.Scatter(
             x=df['date'],
@@ -136,7 +161,8 @@ def plot_alltime_data(option):
 
     return alltimefig
 
-def plot_weekly_data(option, songrange, date_selection):
+def plot_weekly_data(option, songrange, date_selection, chart=DEFAULT_CHART):
+    df = load_table('df_final', chart)
     datetime_selection = datetime.combine(date_selection, datetime.min.time())
     date_closest_before = str(min([i for i in df['date'] if i <= datetime_selection], key=lambda x: abs(x - datetime_selection)).date())
     song_series = pd.Series(df['artist'][date_closest_before]) + ' - ' + pd.Series(df['song'][date_closest_before])
@@ -163,10 +189,7 @@ app = Dash(__name__, external_stylesheets=[dbc.themes.CYBORG])
 load_figure_template("cyborg")
 server = app.server
 s3 = boto3.resource('s3', region_name='us-east-2')
-df = pd.read_json(s3.Object('what-are-we-singing-about', 'df_final.json').get()['Body'].read().decode('UTF-8'))
-df_artist_pop = pd.read_json(s3.Object('what-are-we-singing-about', 'df_artist_pop.json').get()['Body'].read().decode('UTF-8'))
-df_emotion = pd.read_json(s3.Object('what-are-we-singing-about', 'df_emotion.json').get()['Body'].read().decode('UTF-8'))
-df_word_freq = pd.read_json(s3.Object('what-are-we-singing-about', 'df_word_freq.json').get()['Body'].read().decode('UTF-8'))
+df = load_table('df_final', DEFAULT_CHART)
 
 alltimefig = plot_alltime_data("Artist Popularity")
 weeklyfig = plot_weekly_data("Weeks on Chart", [0,25], date.today())
@@ -177,6 +200,9 @@ app.layout = html.Div(children=[dbc.Row(html.H1('What are we Singing About?'),
                                 dbc.Row(html.P("Lyric and metadata analysis of Billboard Hot 100 Songs, updated every week."),
                                         style={'textAlign':'center'
                                                }),
+                                dbc.Row(dbc.Col(dcc.Dropdown([{'label': CHARTS.get(chart, chart), 'value': chart} for chart in DASHBOARD_CHARTS],
+                                                             value=DEFAULT_CHART, clearable=False, id='chart-dropdown'), width=2),
+                                        justify='center', style={'margin-bottom':'15px'}),
                                 dbc.Row([dbc.Col([html.H3("Trends"),
                                                   dbc.Row(dcc.Dropdown(alltime_options,
                                                                        value='Artist Popularity', id='alltime-option-dropdown'),
@@ -194,11 +220,12 @@ app.layout = html.Div(children=[dbc.Row(html.H1('What are we Singing About?'),
 
 @callback(
     Output('alltime-plot', 'figure'),
-    Input('alltime-option-dropdown', 'value')
+    Input('alltime-option-dropdown', 'value'),
+    Input('chart-dropdown', 'value')
 )
 
-def update_alltime_graph(alltime_option):
-    alltimefig = plot_alltime_data(alltime_option)
+def update_alltime_graph(alltime_option, chart):
+    alltimefig = plot_alltime_data(alltime_option, chart)
 
     return alltimefig
 
@@ -206,15 +233,16 @@ def update_alltime_graph(alltime_option):
     Output('weekly-plot', 'figure'),
     Input('weekly-option-dropdown', 'value'),
     Input('range-slider', 'value'),
-    Input('date-picker', 'date')
+    Input('date-picker', 'date'),
+    Input('chart-dropdown', 'value')
 )
 
-def update_weekly_graph(weekly_option, songrange, date_selection):
+def update_weekly_graph(weekly_option, songrange, date_selection, chart):
     try:
         date_formatted = datetime.strptime(date_selection, '%Y-%m-%d').date()
-        weeklyfig = plot_weekly_data(weekly_option, songrange, date_formatted)
+        weeklyfig = plot_weekly_data(weekly_option, songrange, date_formatted, chart)
     except:
-        weeklyfig = plot_weekly_data(weekly_option, songrange, date.today())
+        weeklyfig = plot_weekly_data(weekly_option, songrange, date.today(), chart)
 
     return weeklyfig
 
@@ -0,0 +1,88 @@
+import re
+import requests
+from urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from enrich import LASTFM_API_BASE, LASTFM_NOT_FOUND, MAX_WORKERS, inflight
+from enrich_cache import normalize_key
+from records import decode, ArtistInfo
+from secret_stuff import LASTFM_API_KEY
+
+#Artist-level metadata from Last.fm artist.getInfo, looked up once per unique artist per run and
+#cached across weeks in the enrichment cache under the 'artist' source
+N_SIMILAR = 5
+
+#Split a chart credit into individual artists the same way the transform counts artist popularity
+def credited_artists(artist):
+    names = re.split(r'&|featuring', artist, flags=re.IGNORECASE)
+    return [name.strip() for name in names if name.strip()]
+
+def artist_info_url(name):
+    return LASTFM_API_BASE + '?' + urlencode({'method': 'artist.getInfo', 'api_key': LASTFM_API_KEY, 'artist': name,
+                                              'format': 'json'}, quote_via=quote)
+
+def fetch_artist_info(name, deadline=None):
+    try:
+        response = http_client.get(artist_info_url(name), deadline=deadline)
+        return decode(response.content, ArtistInfo)
+    except (requests.RequestException, ValueError) as e:
+        print(f"Last.fm artist lookup failed for {name}: {e!r}")
+        return None
+
+def artist_fields(artistInfo):
+    fields = {}
+    if 'error' in artistInfo:
+        pass
+    else:
+        fields['artist_name'] = artistInfo['artist']['name']
+        fields['artist_listeners'] = artistInfo['artist']['stats']['listeners']
+        fields['artist_tags'] = [tag['name'] for tag in artistInfo['artist']['tags']['tag']]
+        fields['similar_artists'] = [similar['name'] for similar in artistInfo['artist']['similar']['artist'][:N_SIMILAR]]
+    return fields
+
+#Same contract as the track and lyrics lookups: fields, {} for "not found", None if skipped for time
+def lookup_artist(name, cache=None, deadline=None):
+    if cache is not None:
+        fields = cache.get(name, '', 'artist')
+        if fields is not None:
+            return fields
+    if (deadline is not None) and deadline.expired():
+        return None
+
+    artistInfo = inflight.do((normalize_key(name, ''), 'artist'), lambda: fetch_artist_info(name, deadline))
+    if artistInfo is None:
+        artistInfo = {'error': None}
+    fields = artist_fields(artistInfo)
+    if cache is not None:
+        if fields or (artistInfo.get('error', None) == LASTFM_NOT_FOUND):
+            cache.put(name, '', 'artist', fields)
+        else:
+            fields = cache.peek(name, '', 'artist') or fields
+    return fields
+
+#Look up every artist credited on these entries once, then attach what was found to each entry as 'artists'
+def enrich_artists(entries, cache=None, deadline=None, max_workers=MAX_WORKERS):
+    names = {}
+    for entry in entries:
+        for name in credited_artists(entry['artist']):
+            names.setdefault(name.lower(), name)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = dict(zip(names, executor.map(lambda name: lookup_artist(name, cache, deadline), names.values())))
+
+    for entry in entries:
+        artists = []
+        for name in credited_artists(entry['artist']):
+            fields = found[name.lower()]
+            if fields is None:
+                entry.setdefault('unenriched', [])
+                if 'artist' not in entry['unenriched']:
+                    entry['unenriched'].append('artist')
+            elif fields:
+                artists.append({'name': fields['artist_name'], 'listeners': fields['artist_listeners'],
+                                'tags': fields['artist_tags'], 'similar': fields['similar_artists']})
+        if artists:
+            entry['artists'] = artists
+
+    print(f"Artist enrichment: {len(names)} unique artists for {len(entries)} entries")
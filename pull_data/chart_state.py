@@ -0,0 +1,54 @@
+import re
+import json
+import hashlib
+import boto3
+from botocore.exceptions import ClientError
+
+from enrich_cache import BUCKET
+from charts import DEFAULT_CHART
+
+#ETag and date of the last ingested recent.json, so a retried schedule can skip an unchanged chart.
+#Charts other than the Hot 100 keep theirs under cache/recent_<chart>.json
+STATE_KEY = 'cache/recent_chart.json'
+HASH_METADATA = 'chart-sha256'
+
+def chart_hash(body):
+    return hashlib.sha256(body).hexdigest()
+
+def raw_week_key(date, chart=DEFAULT_CHART):
+    return f"data/{chart}-{date}.json"
+
+#Returns (chart, date) for a raw week key, or None for anything else
+def parse_raw_week_key(key):
+    match = re.fullmatch(r'data/(.+)-(\d{4}-\d{2}-\d{2})\.json', key)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+def state_key(chart=DEFAULT_CHART):
+    if chart == DEFAULT_CHART:
+        return STATE_KEY
+    return f"cache/recent_{chart}.json"
+
+def load_state(bucket=BUCKET, chart=DEFAULT_CHART):
+    s3 = boto3.resource('s3')
+    try:
+        return json.loads(s3.Object(bucket, state_key(chart)).get()['Body'].read().decode('UTF-8'))
+    except s3.meta.client.exceptions.NoSuchKey:
+        return {}
+
+def save_state(state, bucket=BUCKET, chart=DEFAULT_CHART):
+    s3 = boto3.resource('s3')
+    s3.Object(bucket, state_key(chart)).put(Body=json.dumps(state).encode('UTF-8'))
+
+#Returns the chart hash stored with the week's raw file, '' if the file predates hashing, or None if there is no file
+def raw_week_hash(date, bucket=BUCKET, chart=DEFAULT_CHART):
+    s3 = boto3.resource('s3')
+    try:
+        obj = s3.Object(bucket, raw_week_key(date, chart))
+        obj.load()
+        return obj.metadata.get(HASH_METADATA, '')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
@@ -0,0 +1,43 @@
+import os
+
+#Registry of the charts the pipeline can ingest. Each chart gets its own raw weeks (data/<name>-<date>.json),
+#recent-chart state and derived tables (tables/<name>/, see transform_data_package/image/src/table_store.py).
+#Entries are normalized to the Hot 100 schema ('song', 'artist', 'this_week', ...) when a chart is fetched,
+#so everything downstream handles every chart the same way. 'songs' says whether entries are songs that get
+#Last.fm track and lyrics lookups; album charts only get artist enrichment.
+#Charts without a source URL are registered but skipped until one is configured. Source fields a chart
+#maps must also be declared on records.ChartEntry, other fields are dropped when the chart is decoded
+DEFAULT_CHART = 'hot-100'
+CHARTS = {
+    'hot-100': {'title': 'Billboard Hot 100',
+                'recent_url': 'https://raw.githubusercontent.com/mhollingshead/billboard-hot-100/main/recent.json',
+                'historic_base': 'https://raw.githubusercontent.com/mhollingshead/billboard-hot-100/main/date/',
+                'fields': {}, 'songs': True},
+    'billboard-200': {'title': 'Billboard 200',
+                      'recent_url': os.environ.get('BILLBOARD_200_RECENT_URL', None),
+                      'historic_base': os.environ.get('BILLBOARD_200_HISTORIC_BASE', None),
+                      'fields': {'album': 'song'}, 'songs': False},
+}
+
+def get_chart(name):
+    if name not in CHARTS:
+        raise ValueError(f"Unknown chart {name!r}, expected one of {', '.join(CHARTS)}")
+    return CHARTS[name]
+
+def enabled_charts():
+    return [name for name, config in CHARTS.items() if config['recent_url']]
+
+def chart_url(name, date_string=None):
+    config = get_chart(name)
+    if date_string:
+        return config['historic_base'] + date_string + '.json'
+    return config['recent_url']
+
+#Copy chart-specific fields onto the names the rest of the pipeline uses, keeping the originals
+def normalize_chart(hot_100, name):
+    fields = get_chart(name)['fields']
+    for entry in hot_100['data']:
+        for source_field, field in fields.items():
+            if (source_field in entry) and (field not in entry):
+                entry[field] = entry[source_field]
+    return hot_100
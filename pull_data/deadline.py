@@ -0,0 +1,20 @@
+import time
+
+#Time kept back for the last in-flight requests, saving the cache and uploading the week
+RESERVE_MS = 30000
+
+class Deadline:
+
+    #Wall-clock budget for one run. Enrichment stops starting new lookups once it has run out
+    def __init__(self, remaining_ms, reserve_ms=RESERVE_MS):
+        self.expires_at = time.monotonic() + (remaining_ms - reserve_ms)/1000
+
+    @classmethod
+    def from_context(cls, context, reserve_ms=RESERVE_MS):
+        return cls(context.get_remaining_time_in_millis(), reserve_ms)
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
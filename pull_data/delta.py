@@ -0,0 +1,58 @@
+import boto3
+from datetime import date, timedelta
+
+from enrich_cache import normalize_key, BUCKET
+from chart_state import raw_week_key
+from charts import DEFAULT_CHART
+from raw_lake import load_raw_week
+from lyrics_store import LYRICS_HASH_FIELD
+
+#Fields that don't change from week to week are copied from the previous week's raw file.
+#Listener and play counts drift, so they are still refreshed from Last.fm.
+TRACK_FIELDS = ['duration', 'lastfm_listeners', 'lastfm_playcount', 'toptags', 'summary']
+DRIFTING_TRACK_FIELDS = ['lastfm_listeners', 'lastfm_playcount']
+REFRESH_DRIFTING = True
+
+def load_previous_week(date_string, bucket=BUCKET, chart=DEFAULT_CHART):
+    previous_date = date.fromisoformat(date_string) - timedelta(days=7)
+    s3 = boto3.resource('s3')
+    try:
+        return load_raw_week(raw_week_key(str(previous_date), chart), bucket)[0]
+    except s3.meta.client.exceptions.NoSuchKey:
+        return None
+
+def index_entries(entries):
+    return {normalize_key(entry['artist'], entry['song']): entry for entry in entries}
+
+#Returns the fields that can be carried forward for this entry, by source. A source is only
+#carried if last week's lookup actually succeeded, so last week's gaps are retried.
+def carry_forward(entry, previous):
+    carried = {}
+    if not previous:
+        return carried
+    previous_entry = previous.get(normalize_key(entry['artist'], entry['song']), None)
+    if previous_entry is None:
+        return carried
+
+    unenriched = previous_entry.get('unenriched', [])
+    if ('duration' in previous_entry) and ('track' not in unenriched):
+        carried['track'] = {key: previous_entry[key] for key in TRACK_FIELDS if key in previous_entry}
+    #Lyrics kept in the blob store are carried as the reference, without fetching the blob
+    if ('lyrics' in previous_entry) and ('lyrics' not in unenriched):
+        carried['lyrics'] = {'lyrics': previous_entry['lyrics']}
+    elif (LYRICS_HASH_FIELD in previous_entry) and ('lyrics' not in unenriched):
+        carried['lyrics'] = {LYRICS_HASH_FIELD: previous_entry[LYRICS_HASH_FIELD]}
+    return carried
+
+#Stable fields come from last week, drifting ones from the fresh lookup when there is one
+def merge_track_fields(carried, fresh):
+    if not fresh:
+        return carried
+    merged = {}
+    for key in TRACK_FIELDS:
+        if (key in DRIFTING_TRACK_FIELDS) or (key not in carried):
+            if key in fresh:
+                merged[key] = fresh[key]
+        else:
+            merged[key] = carried[key]
+    return merged
@@ -0,0 +1,215 @@
+import threading
+import requests
+from urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import http_client
+from lyrics_providers import get_lyrics_fetcher
+from normalize import memo
+from delta import carry_forward, merge_track_fields, REFRESH_DRIFTING
+from enrich_cache import normalize_key
+from records import decode, TrackInfo
+from secret_stuff import LASTFM_API_KEY
+
+LASTFM_API_BASE = 'http://ws.audioscrobbler.com/2.0/'
+
+#Per-upstream concurrency, rate limits and retries live in http_client
+MAX_WORKERS = 16
+
+def track_info_url(artist, song):
+    return LASTFM_API_BASE + '?' + urlencode({'method': 'track.getInfo', 'api_key': LASTFM_API_KEY, 'artist': artist,
+                                              'track': song, 'format': 'json'}, quote_via=quote)
+
+#Last.fm error code for "The track you supplied could not be found"
+LASTFM_NOT_FOUND = 6
+
+#Both fetches return None when the upstream could not be reached or kept failing after retries.
+#Query variants are only tried on a "not found", never on errors
+def fetch_track_info(entry, get=None, deadline=None):
+    for artist, song in memo.variants_for(entry, 'lastfm'):
+        try:
+            response = (get or http_client.get)(track_info_url(artist, song), deadline=deadline)
+            trackInfo = decode(response.content, TrackInfo)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Last.fm lookup failed for {entry['song']} by {entry['artist']}: {e!r}")
+            return None
+        if trackInfo.get('error', None) != LASTFM_NOT_FOUND:
+            if 'error' not in trackInfo:
+                memo.put(entry['artist'], entry['song'], 'lastfm', (artist, song))
+            return trackInfo
+    return trackInfo
+
+#Lyrics come from the configured providers, hedging slow ones (see lyrics_providers)
+def fetch_lyrics(entry, get=None, deadline=None):
+    return get_lyrics_fetcher().fetch(entry, deadline, get)
+
+#Pick out the fields we keep. An empty dict means the upstream has nothing for this song.
+def track_fields(trackInfo):
+    fields = {}
+    if 'error' in trackInfo:
+        pass
+    else:
+        fields['duration'] = trackInfo['track']['duration']
+        fields['lastfm_listeners'] = trackInfo['track']['listeners']
+        fields['lastfm_playcount'] = trackInfo['track']['playcount']
+        fields['toptags'] = trackInfo['track']['toptags']
+        if 'wiki' in trackInfo['track']:
+            fields['summary'] = trackInfo['track']['wiki']['summary']
+    return fields
+
+def lyrics_fields(lyrics):
+    fields = {}
+    if 'lyrics' in lyrics:
+        fields['lyrics'] = lyrics['lyrics']
+    return fields
+
+class SingleFlight:
+
+    #Concurrent lookups of the same key share one upstream request. Several charts pulled at once
+    #often have songs in common, and the cache only helps once the first lookup has finished
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fetch):
+        with self.lock:
+            call = self.calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        try:
+            result = fetch()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+inflight = SingleFlight()
+
+#Each lookup checks the cache first and only stores answers that are definitive,
+#so rate limits and network errors are retried on the next run instead of being remembered.
+#A lookup that would have to go upstream after the deadline has passed returns None instead.
+#Fields carried forward from last week replace the lookup, apart from the drifting Last.fm counts.
+def lookup_track(entry, get=None, cache=None, deadline=None, carried=None):
+    if carried is not None:
+        if not REFRESH_DRIFTING:
+            return carried
+        return merge_track_fields(carried, lookup_track(entry, get, cache, deadline))
+
+    if cache is not None:
+        fields = cache.get(entry['artist'], entry['song'], 'track')
+        if fields is not None:
+            return fields
+    if (deadline is not None) and deadline.expired():
+        return None
+
+    trackInfo = inflight.do((normalize_key(entry['artist'], entry['song']), 'track'), lambda: fetch_track_info(entry, get, deadline))
+    if trackInfo is None:
+        trackInfo = {'error': None}
+    fields = track_fields(trackInfo)
+    if cache is not None:
+        if fields or (trackInfo.get('error', None) == LASTFM_NOT_FOUND):
+            cache.put(entry['artist'], entry['song'], 'track', fields)
+        else:
+            fields = cache.peek(entry['artist'], entry['song'], 'track') or fields
+    return fields
+
+def lookup_lyrics(entry, get=None, cache=None, deadline=None, carried=None):
+    if carried is not None:
+        return carried
+
+    if cache is not None:
+        fields = cache.get(entry['artist'], entry['song'], 'lyrics')
+        if fields is not None:
+            return fields
+    if (deadline is not None) and deadline.expired():
+        return None
+
+    lyrics = inflight.do((normalize_key(entry['artist'], entry['song']), 'lyrics'), lambda: fetch_lyrics(entry, get, deadline))
+    if lyrics is None:
+        if cache is not None:
+            return cache.peek(entry['artist'], entry['song'], 'lyrics') or {}
+        return {}
+
+    fields = lyrics_fields(lyrics)
+    if cache is not None:
+        cache.put(entry['artist'], entry['song'], 'lyrics', fields)
+    return fields
+
+#Copy the fields onto the entry. Kept separate from the lookups so that the
+#sequential and concurrent modes write keys in exactly the same order.
+#Lookups skipped for lack of time are listed under 'unenriched' so they can be filled in later.
+def apply_fields(entry, fields, source):
+    if fields is None:
+        entry.setdefault('unenriched', []).append(source)
+        return
+    for key, value in fields.items():
+        entry[key] = value
+
+#Top chart positions are looked up first so a run that runs out of time loses the least important songs
+def priority_order(entries):
+    return sorted(entries, key=lambda entry: entry['this_week'])
+
+def enrich_sequential(entries, cache=None, deadline=None, previous=None):
+    count = 1
+    results = {}
+    for entry in priority_order(entries):
+
+        print(f"Gathering data for song {count} - {entry['song']} by {entry['artist']}")
+        count += 1
+
+        carried = carry_forward(entry, previous)
+        results[id(entry)] = (lookup_track(entry, None, cache, deadline, carried.get('track', None)),
+                              lookup_lyrics(entry, None, cache, deadline, carried.get('lyrics', None)))
+
+    for entry in entries:
+        track, lyrics = results[id(entry)]
+        apply_fields(entry, track, 'track')
+        apply_fields(entry, lyrics, 'lyrics')
+
+def enrich_concurrent(entries, max_workers=MAX_WORKERS, cache=None, deadline=None, previous=None):
+
+    #Submit both lookups for every entry up front in priority order, then apply the results in chart order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        count = 1
+        for entry in priority_order(entries):
+            print(f"Gathering data for song {count} - {entry['song']} by {entry['artist']}")
+            count += 1
+            carried = carry_forward(entry, previous)
+            futures[id(entry)] = (executor.submit(lookup_track, entry, None, cache, deadline, carried.get('track', None)),
+                                  executor.submit(lookup_lyrics, entry, None, cache, deadline, carried.get('lyrics', None)))
+
+        for entry in entries:
+            track_future, lyrics_future = futures[id(entry)]
+            apply_fields(entry, track_future.result(), 'track')
+            apply_fields(entry, lyrics_future.result(), 'lyrics')
+
+LOOKUPS = {'track': lookup_track, 'lyrics': lookup_lyrics}
+
+#Group entries from any number of weeks by normalized (artist, song), keeping the first entry seen
+def unique_songs(entries):
+    songs = {}
+    for entry in entries:
+        songs.setdefault(normalize_key(entry['artist'], entry['song']), entry)
+    return songs
+
+#Look up each song once no matter how many weeks it appears in. `wanted` maps a normalized key
+#to (representative entry, sources to look up); returns {key: {source: fields}}
+def enrich_unique(wanted, max_workers=MAX_WORKERS, cache=None, deadline=None):
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for key, (entry, sources) in wanted.items():
+            for source in sources:
+                futures[(key, source)] = executor.submit(LOOKUPS[source], entry, None, cache, deadline)
+        for (key, source), future in futures.items():
+            results.setdefault(key, {})[source] = future.result()
+    return results
@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import time
+import threading
+import boto3
+
+from s3_conditional import conditional_put, ConflictError
+
+BUCKET = 'what-are-we-singing-about'
+CACHE_KEY = 'cache/enrichment.json'
+
+#Time-to-live in seconds for each cached field. Lyrics never change, listener counts drift week to week.
+DAY = 86400
+FIELD_TTLS = {'duration': 180*DAY, 'lastfm_listeners': 7*DAY, 'lastfm_playcount': 7*DAY,
+              'toptags': 30*DAY, 'summary': 180*DAY, 'lyrics': None,
+              'artist_name': None, 'artist_listeners': 7*DAY, 'artist_tags': 30*DAY, 'similar_artists': 30*DAY}
+NEGATIVE_TTL = 14*DAY
+MAX_ENTRIES = 20000
+SAVE_RETRIES = 5
+
+def normalize_key(artist, song):
+    artist = re.sub(r'\s+', ' ', artist).strip().lower()
+    song = re.sub(r'\s+', ' ', song).strip().lower()
+    return f"{artist}|{song}"
+
+class LocalCacheStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        #Write to a temporary file first so a crash never leaves a half-written cache behind
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.replace(self.path + '.tmp', self.path)
+
+#Saves are conditional on the ETag of the copy that was loaded, so several writers (shard workers, backfills)
+#can't overwrite each other; a save raises ConflictError if the cache changed since it was loaded
+class S3CacheStore:
+
+    def __init__(self, bucket=BUCKET, key=CACHE_KEY):
+        self.bucket = bucket
+        self.key = key
+        self.etag = None
+
+    def load(self):
+        s3 = boto3.resource('s3')
+        try:
+            response = s3.Object(self.bucket, self.key).get()
+        except s3.meta.client.exceptions.NoSuchKey:
+            self.etag = None
+            return {}
+        self.etag = response['ETag']
+        return json.loads(response['Body'].read().decode('UTF-8'))
+
+    def save(self, records):
+        self.etag = conditional_put(self.bucket, self.key, json.dumps(records).encode('UTF-8'), self.etag)
+
+class EnrichmentCache:
+
+    #Cache of enrichment results keyed by normalized (artist, song), one record per source ('track', 'lyrics').
+    #Artist-level records use an empty song and the 'artist' source.
+    #A record with no fields is a negative entry: the upstream answered "not found".
+    #Lyrics are kept in the lyrics blob store (see lyrics_store) and the cache only holds their hash, which is
+    #what a hit returns, like lyrics carried forward from last week. Records from before that, with the text
+    #inline, are moved to the blob store when they are hit and dropped when the cache is saved.
+    #Reads don't make the cache dirty, so a run that only hits the cache doesn't write it back
+    def __init__(self, store, field_ttls=FIELD_TTLS, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES, lyrics_store=None):
+        self.store = store
+        self.lyrics_store = lyrics_store
+        self.field_ttls = field_ttls
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.records = store.load()
+        self.dirty = False
+        self.updated = set()
+        self.counters = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    def is_fresh(self, record, now):
+        age = now - record['stored']
+        if not record['fields']:
+            return age < self.negative_ttl
+        for field in record['fields']:
+            ttl = self.field_ttls.get(field, None)
+            if (ttl is not None) and (age >= ttl):
+                return False
+        return True
+
+    #Imported here because lyrics_store takes the bucket name from this module
+    def blobs(self):
+        with self.lock:
+            if self.lyrics_store is None:
+                from lyrics_store import LyricsBlobStore
+                self.lyrics_store = LyricsBlobStore()
+            return self.lyrics_store
+
+    #Lyrics go to the blob store and are replaced by their hash
+    def by_reference(self, source, fields):
+        if (source != 'lyrics') or ('lyrics' not in fields):
+            return fields
+        from lyrics_store import LYRICS_HASH_FIELD
+        lyrics_sha256 = self.blobs().put(fields['lyrics'])
+        fields = {key: value for key, value in fields.items() if key != 'lyrics'}
+        fields[LYRICS_HASH_FIELD] = lyrics_sha256
+        return fields
+
+    #Returns the cached fields for this source, an empty dict for a cached "not found", or None on a miss
+    def get(self, artist, song, source):
+        now = time.time()
+        with self.lock:
+            entry = self.records.get(normalize_key(artist, song), None)
+            if (entry is None) or (source not in entry):
+                self.counters['misses'] += 1
+                return None
+            record = entry[source]
+            if not self.is_fresh(record, now):
+                self.counters['stale'] += 1
+                return None
+
+            entry['accessed'] = now
+            if record['fields']:
+                self.counters['hits'] += 1
+            else:
+                self.counters['negative_hits'] += 1
+            fields = dict(record['fields'])
+        if (source == 'lyrics') and ('lyrics' in fields):
+            fields = self.by_reference(source, fields)
+            with self.lock:
+                record['fields'] = dict(fields)
+                self.dirty = True
+                self.updated.add(normalize_key(artist, song))
+        return fields
+
+    #Returns the cached fields regardless of age, for use when a refresh fails
+    def peek(self, artist, song, source):
+        with self.lock:
+            entry = self.records.get(normalize_key(artist, song), {})
+            if source in entry:
+                return dict(entry[source]['fields'])
+            return None
+
+    def put(self, artist, song, source, fields):
+        fields = self.by_reference(source, fields)
+        now = time.time()
+        with self.lock:
+            entry = self.records.setdefault(normalize_key(artist, song), {})
+            entry[source] = {'stored': now, 'fields': dict(fields)}
+            entry['accessed'] = now
+            self.dirty = True
+            self.updated.add(normalize_key(artist, song))
+
+    #Records written by this process, so workers that can't save the shared cache can hand them back
+    def updates(self):
+        with self.lock:
+            return {key: self.records[key] for key in self.updated if key in self.records}
+
+    def merge(self, records):
+        with self.lock:
+            self.records.update(records)
+            self.updated.update(records)
+            self.dirty = True
+
+    def evict(self):
+        now = time.time()
+        with self.lock:
+
+            #Drop expired "not found" entries and inline lyrics, then the least recently used songs over the size limit
+            n_records = len(self.records)
+            for key in list(self.records):
+                entry = self.records[key]
+                for source in [s for s in entry if s != 'accessed']:
+                    fields = entry[source]['fields']
+                    if (not fields and not self.is_fresh(entry[source], now)) or ((source == 'lyrics') and ('lyrics' in fields)):
+                        del entry[source]
+                        self.dirty = True
+                if len(entry) == 1:
+                    del self.records[key]
+
+            n_over = len(self.records) - self.max_entries
+            if n_over > 0:
+                oldest = sorted(self.records, key=lambda key: self.records[key]['accessed'])[:n_over]
+                for key in oldest:
+                    del self.records[key]
+            if len(self.records) < n_records:
+                self.counters['evictions'] += n_records - len(self.records)
+                self.dirty = True
+
+    #When another writer saved the cache since it was loaded, their copy is loaded, the records this process
+    #wrote are laid over it and the save is tried again
+    def save(self):
+        if not self.dirty:
+            return
+        for attempt in range(SAVE_RETRIES):
+            self.evict()
+            with self.lock:
+                try:
+                    self.store.save(self.records)
+                    self.dirty = False
+                    return
+                except ConflictError:
+                    print('Enrichment cache changed while saving, merging and retrying')
+                    ours = {key: self.records[key] for key in self.updated if key in self.records}
+                    self.records = self.store.load()
+                    self.records.update(ours)
+        raise ConflictError(f"Gave up saving the enrichment cache after {SAVE_RETRIES} attempts")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.records)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses'] + stats['stale']
+        stats['hit_rate'] = (stats['hits'] + stats['negative_hits'])/lookups if lookups else 0.
+        return stats
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+#One pooled keep-alive session per upstream. Rates are requests per second; Last.fm asks for
+#no more than 5 per second per IP, the other two publish no limit so we stay polite.
+UPSTREAMS = {
+    'github': {'hosts': ['raw.githubusercontent.com'], 'rate': 20., 'burst': 20, 'concurrency': 8},
+    'lastfm': {'hosts': ['ws.audioscrobbler.com'], 'rate': 5., 'burst': 5, 'concurrency': 4},
+    'lyrist': {'hosts': ['lyrist.vercel.app'], 'rate': 10., 'burst': 10, 'concurrency': 8},
+}
+DEFAULT_UPSTREAM = {'hosts': [], 'rate': 5., 'burst': 5, 'concurrency': 4}
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15.
+MAX_ATTEMPTS = 4
+RETRY_STATUS = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.
+
+#Fraction of each upstream's rate this process may use, for when several processes share one limit
+RATE_SHARE = 1.
+
+#When set, every request is sent here instead of the real upstream (e.g. utilities/mock_upstream.py),
+#as <REDIRECT_BASE>/<original host><original path>
+REDIRECT_BASE = None
+
+#Callables run after every attempt as observer(upstream, url, response, error, elapsed),
+#used for recording cassettes and collecting latencies
+observers = []
+
+class TokenBucket:
+
+    #Hands out `rate` tokens per second, allowing bursts of up to `capacity` requests
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+class UpstreamClient:
+
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        #After a 429/5xx every caller of this upstream holds off until resume_at, not just the one that was throttled
+        self.lock = threading.Lock()
+        self.resume_at = 0.
+
+    def backoff_delay(self, attempt, response=None):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE*2**attempt)*random.uniform(0.5, 1.)
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, min(float(retry_after), BACKOFF_MAX))
+        return delay
+
+    def hold_off(self, delay):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+    #Sleeps are cut short at the deadline, so backing off never runs into the time kept back for uploading
+    def pause(self, delay, deadline=None):
+        if deadline is not None:
+            delay = min(delay, deadline.remaining())
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait(self, deadline=None):
+        with self.lock:
+            pause = self.resume_at - time.monotonic()
+        self.pause(pause, deadline)
+
+    def notify(self, url, response, error, elapsed):
+        for observer in observers:
+            observer(self.name, url, response, error, elapsed)
+
+    #GET with timeouts and jittered exponential retries on connection errors, timeouts, 429 and 5xx.
+    #The last response is returned (or the last exception raised) once the attempts run out,
+    #or as soon as the optional deadline has passed, without sleeping or retrying past it.
+    def get(self, url, deadline=None, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        expired = lambda: (deadline is not None) and deadline.expired()
+        for attempt in range(MAX_ATTEMPTS):
+            self.wait(deadline)
+            self.bucket.acquire()
+            last_attempt = (attempt == MAX_ATTEMPTS - 1)
+            start = time.perf_counter()
+            try:
+                with self.semaphore:
+                    response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.notify(url, None, e, time.perf_counter() - start)
+                if last_attempt or expired():
+                    raise
+                self.pause(self.backoff_delay(attempt), deadline)
+                if expired():
+                    raise
+                continue
+            self.notify(url, response, None, time.perf_counter() - start)
+
+            if (response.status_code not in RETRY_STATUS) or last_attempt or expired():
+                return response
+            self.hold_off(self.backoff_delay(attempt, response))
+            self.wait(deadline)
+            if expired():
+                return response
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(name):
+    with _clients_lock:
+        if name not in _clients:
+            config = UPSTREAMS.get(name, DEFAULT_UPSTREAM)
+            rate = config['rate']*RATE_SHARE
+            burst = max(1, int(config['burst']*RATE_SHARE))
+            _clients[name] = UpstreamClient(name, rate, burst, config['concurrency'])
+        return _clients[name]
+
+#Drop all sessions and rate-limit state, e.g. between benchmark runs
+def reset_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.session.close()
+        _clients.clear()
+
+def set_rate_share(share):
+    global RATE_SHARE
+    RATE_SHARE = share
+    reset_clients()
+
+def upstream_for_url(url):
+    host = urlparse(url).netloc
+    for name, config in UPSTREAMS.items():
+        if host in config['hosts']:
+            return name
+    return host
+
+def redirect_url(url):
+    parsed = urlparse(url)
+    redirected = REDIRECT_BASE.rstrip('/') + '/' + parsed.netloc + parsed.path
+    if parsed.query:
+        redirected += '?' + parsed.query
+    return redirected
+
+def get(url, **kwargs):
+    client = get_client(upstream_for_url(url))
+    if REDIRECT_BASE:
+        url = redirect_url(url)
+    return client.get(url, **kwargs)
+
+#GET a JSON document through a local conditional-request cache: the body and ETag are kept on disk
+#and the request carries If-None-Match, so an unchanged document costs a 304 and no download
+def get_json_cached(url, path):
+    cached = None
+    headers = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+
+    response = get(url, headers=headers)
+    if (response.status_code == 304) and (cached is not None):
+        return cached['body']
+    response.raise_for_status()
+
+    body = response.json()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'etag': response.headers.get('ETag', ''), 'body': body}, f)
+    return body
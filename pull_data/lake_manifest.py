@@ -0,0 +1,123 @@
+import json
+import threading
+import contextlib
+import boto3
+
+from enrich_cache import BUCKET
+from chart_state import parse_raw_week_key
+from charts import DEFAULT_CHART
+from s3_conditional import conditional_put, ConflictError
+
+#Index of every raw week in the lake, so finding weeks takes one GET instead of listing data/:
+#   {'complete': bool, 'weeks': {key: {'chart', 'date', 'format', 'size', 'sha256', 'entries', 'etag'}}}
+#A manifest is only complete once utilities/reconcile_lake.py has recorded every week already in the bucket.
+#Writers record their weeks either way, creating the manifest if there is none, but until it is complete
+#weeks() returns None and readers list data/ instead, so weeks written before the manifest aren't missed.
+#sha256 is what the week is checked against when read: the hash of the document for JSON weeks and of the
+#uncompressed lines for NDJSON weeks (see raw_lake). raw_lake records every week it writes. Updates are conditional
+#on the manifest's ETag (see s3_conditional) and are re-applied to a fresh copy when another process got there first.
+#utilities/reconcile_lake.py rebuilds the manifest from a full listing
+LAKE_MANIFEST_KEY = 'manifests/raw_weeks.json'
+MANIFEST_RETRIES = 5
+
+def week_record(key, raw_format, size, sha256, entries, etag=None):
+    chart, date = parse_raw_week_key(key)
+    return {'chart': chart, 'date': date, 'format': raw_format, 'size': size, 'sha256': sha256, 'entries': entries, 'etag': etag}
+
+class LakeManifest:
+
+    def __init__(self, bucket=BUCKET):
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.etag = None
+
+    def load(self):
+        s3 = boto3.resource('s3')
+        try:
+            response = s3.Object(self.bucket, LAKE_MANIFEST_KEY).get()
+        except s3.meta.client.exceptions.NoSuchKey:
+            self.manifest, self.etag = None, None
+            return None
+        self.manifest = json.loads(response['Body'].read())
+        self.etag = response['ETag']
+        return self.manifest
+
+    #Apply change(weeks) to the manifest and write it. The first write of a process reuses the copy it already
+    #holds; on a conflict the manifest is read again and the change re-applied. complete=True is only for reconcile_lake
+    def update(self, change, complete=None):
+        with self.lock:
+            for attempt in range(MANIFEST_RETRIES):
+                if (self.manifest is None) or (attempt > 0):
+                    self.load()
+                manifest = self.manifest or {'complete': False, 'weeks': {}}
+                change(manifest['weeks'])
+                if complete is not None:
+                    manifest['complete'] = complete
+                try:
+                    self.etag = conditional_put(self.bucket, LAKE_MANIFEST_KEY, json.dumps(manifest, sort_keys=True).encode('UTF-8'), self.etag)
+                    self.manifest = manifest
+                    return
+                except ConflictError:
+                    print('Lake manifest changed while updating it, retrying')
+            raise ConflictError(f"Gave up updating {LAKE_MANIFEST_KEY} after {MANIFEST_RETRIES} attempts")
+
+    def record(self, records):
+        self.update(lambda weeks: weeks.update(records))
+
+    def complete(self):
+        return (self.manifest is not None) and self.manifest.get('complete', False)
+
+    #Records of one chart's weeks (every chart's when chart is None) between start and end inclusive, in date order.
+    #Always reads the current manifest, in one GET. None if there is no manifest yet, or if it isn't complete
+    #unless incomplete=True
+    def weeks(self, chart=DEFAULT_CHART, start=None, end=None, incomplete=False):
+        with self.lock:
+            manifest = self.load()
+        if (manifest is None) or not (incomplete or manifest.get('complete', False)):
+            return None
+        return {key: record for key, record in sorted(manifest['weeks'].items(), key=lambda item: (item[1]['date'], item[0]))
+                if ((chart is None) or (record['chart'] == chart)) and
+                   ((start is None) or (record['date'] >= start)) and ((end is None) or (record['date'] <= end))}
+
+    def keys(self, chart=DEFAULT_CHART, start=None, end=None):
+        weeks = self.weeks(chart, start, end)
+        return None if weeks is None else list(weeks)
+
+manifests = {}
+pending = {}
+pending_lock = threading.Lock()
+batch_depth = 0
+
+def lake_manifest(bucket=BUCKET):
+    with pending_lock:
+        if bucket not in manifests:
+            manifests[bucket] = LakeManifest(bucket)
+        return manifests[bucket]
+
+#Record weeks written by raw_lake. During a batch() they are held until it ends and then written in one update
+def record_weeks(records, bucket=BUCKET):
+    with pending_lock:
+        if batch_depth > 0:
+            pending.setdefault(bucket, {}).update(records)
+            return
+    lake_manifest(bucket).record(records)
+
+#For backfills and rewrites that write many weeks: one manifest update at the end instead of one per week.
+#Batches cover the whole process, so weeks written by the threads a batch starts are held too
+@contextlib.contextmanager
+def batch():
+    global batch_depth
+    with pending_lock:
+        batch_depth += 1
+    try:
+        yield
+    finally:
+        with pending_lock:
+            batch_depth -= 1
+            buckets = {}
+            if batch_depth == 0:
+                buckets = dict(pending)
+                pending.clear()
+        for bucket, records in buckets.items():
+            lake_manifest(bucket).record(records)
@@ -1,59 +1,185 @@
 import json
-import requests
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 
-from secret_stuff import LASTFM_API_KEY
+import http_client
+import raw_lake
+from enrich import enrich_sequential, enrich_concurrent, MAX_WORKERS
+from enrich_cache import EnrichmentCache, S3CacheStore
+from deadline import Deadline
+from delta import load_previous_week, index_entries, carry_forward
+from lyrics_providers import get_lyrics_fetcher
+from artists import enrich_artists
+from normalize import memo
+from lyrics_store import LyricsBlobStore, externalize_lyrics, LYRICS_BLOBS
+from metrics import RunMetrics
+from shards import split_shards, enrich_shard, load_partials, merge_shards, run_shards_lambda, S3ShardStore
+from chart_state import chart_hash, raw_week_hash, load_state, save_state
+from records import decode, Chart
+from charts import CHARTS, DEFAULT_CHART, chart_url, normalize_chart, enabled_charts, get_chart
 
-HOT_100_URL = 'https://raw.githubusercontent.com/mhollingshead/billboard-hot-100/main/recent.json'
-HOT_100_HISTORIC_BASE = 'https://raw.githubusercontent.com/mhollingshead/billboard-hot-100/main/date/'
-LASTFM_API_BASE = 'http://ws.audioscrobbler.com/2.0/'
-LYRIST_API_BASE = 'https://lyrist.vercel.app/api/'
+#Chart sources live in the chart registry (see charts)
+HOT_100_URL = CHARTS[DEFAULT_CHART]['recent_url']
+HOT_100_HISTORIC_BASE = CHARTS[DEFAULT_CHART]['historic_base']
+
+#Number of worker invocations a scheduled run fans enrichment out to. 1 enriches in-process
+N_SHARDS = 1
+
+#Returns the chart for one historic week along with the hash of its source document
+def fetch_historic_chart(date_string, chart=DEFAULT_CHART):
+    response = http_client.get(chart_url(chart, date_string))
+    response.raise_for_status()
+    return normalize_chart(decode(response.content, Chart), chart), chart_hash(response.content)
+
+#Upload JSON data to s3, tagged with the hash of the chart it was built from (see raw_lake for the formats).
+#With lyric blobs turned on, lyrics are stored once in the blob store and the week only references them
+def upload_raw_week(hot_100, content_hash, raw_format=None, lyrics_store=None, chart=DEFAULT_CHART):
+    if (lyrics_store is None) and LYRICS_BLOBS:
+        lyrics_store = LyricsBlobStore()
+    if lyrics_store is not None:
+        externalize_lyrics(hot_100['data'], lyrics_store)
+    raw_lake.upload_raw_week(hot_100, content_hash, raw_format, chart=chart)
 
 def pull_data(**kwargs):
 
-    #If date_string in kwargs, use that date. If not
+    #If date_string in kwargs, use that date. If not, pull the most recent chart
+    #chart picks the chart from the registry (see charts), the Hot 100 by default
     date_string = kwargs.get('date_string', None)
-    if date_string:
-        url = HOT_100_HISTORIC_BASE + date_string + '.json'
-    else:
-        url = HOT_100_URL
+    force = kwargs.get('force', False)
+    chart = kwargs.get('chart', DEFAULT_CHART)
+    url = chart_url(chart, date_string)
+
+    #recent.json is fetched conditionally on the ETag we saw last time. A 304 means the chart
+    #hasn't changed since the week we last ingested, so there is nothing to do
+    state = {}
+    headers = {}
+    if not date_string:
+        state = load_state(chart=chart)
+        if ('etag' in state) and not force:
+            headers['If-None-Match'] = state['etag']
+    response = http_client.get(url, headers=headers)
+    if response.status_code == 304:
+        if raw_week_hash(state['date'], chart=chart) is not None:
+            print(f"Chart unchanged since {state['date']} was ingested, nothing to do")
+            return
+        response = http_client.get(url)
+    response.raise_for_status()
 
-    response = requests.get(url)
-    hot_100 = response.json()
+    body = response.content
+    hot_100 = normalize_chart(decode(body, Chart), chart)
     date = hot_100['date']
 
-    #For each entry, attempt to grab metadata from last.fm and lyrics from lyrist
-    count = 1
-    for entry in hot_100['data']:
+    #Skip weeks that are already in the lake with identical chart content
+    content_hash = chart_hash(body)
+    if (raw_week_hash(date, chart=chart) == content_hash) and not force:
+        print(f"Week {date} of {chart} already ingested with the same chart, nothing to do")
+        if not date_string:
+            save_state({'etag': response.headers.get('ETag', ''), 'date': date}, chart=chart)
+        return
 
-        print(f"Gathering data for song {count} - {entry['song']} by {entry['artist']}")
-        count += 1
+    #Songs seen in earlier runs are served from the enrichment cache. Callers pulling several weeks
+    #can pass in their own cache and save it themselves; otherwise the shared S3 cache is used
+    cache = kwargs.get('cache', None)
+    owns_cache = (cache is None) and kwargs.get('use_cache', True)
+    if owns_cache:
+        cache = EnrichmentCache(S3CacheStore())
+    if cache is not None:
+        memo.use_cache(cache)
 
-        response = requests.get(LASTFM_API_BASE + f"?method=track.getInfo&api_key={LASTFM_API_KEY}&artist={entry['artist']}&track={entry['song']}&format=json")
-        trackInfo = response.json()
-        if 'error' in trackInfo:
-            pass
+    #In delta mode, songs that were on last week's chart reuse last week's lyrics and stable metadata
+    previous = None
+    if kwargs.get('delta', False):
+        previous_week = load_previous_week(date, chart=chart)
+        if previous_week is not None:
+            previous = index_entries(previous_week['data'])
+            n_carried = len([entry for entry in hot_100['data'] if carry_forward(entry, previous)])
+            print(f"Delta enrichment: {n_carried} songs carried forward, {len(hot_100['data']) - n_carried} fetched")
         else:
-            entry['duration'] = trackInfo['track']['duration']
-            entry['lastfm_listeners'] = trackInfo['track']['listeners']
-            entry['lastfm_playcount'] = trackInfo['track']['playcount']
-            entry['toptags'] = trackInfo['track']['toptags']
-            if 'wiki' in trackInfo['track']:
-                entry['summary'] = trackInfo['track']['wiki']['summary']
-
-        try:
-            response = requests.get(LYRIST_API_BASE + f"/{entry['artist'].replace(' ', '+')}/{entry['song'].replace(' ', '+')}")
-            response.raise_for_status()
-            lyrics = response.json()
-            if 'lyrics' in lyrics:
-                entry['lyrics'] = response.json()['lyrics']
-        except:
-            pass
-
-    #Upload JSON data to s3
-    s3 = boto3.resource('s3')
-    obj = s3.Object(bucket_name='what-are-we-singing-about', key=f"data/hot-100-{hot_100['date']}.json")
-    obj.put(Body=bytes(json.dumps(hot_100).encode('UTF-8')))
+            print("Delta enrichment: no raw file for the previous week, fetching everything")
+
+    #For each entry, attempt to grab metadata from last.fm and lyrics from lyrist
+    #By default all lookups are made at once with per-host limits; pass concurrent=False to go one song at a time
+    #With a deadline, lookups stop once time runs short and the week is uploaded with whatever we have
+    #With n_shards > 1, the entries are split across workers and their partial results merged back
+    deadline = kwargs.get('deadline', None)
+    n_shards = kwargs.get('n_shards', 1)
+    #Album charts skip the per-song lookups and only get artist metadata
+    if not get_chart(chart)['songs']:
+        pass
+    elif n_shards > 1:
+        shard_store = kwargs.get('shard_store', None) or S3ShardStore()
+        shard_runner = kwargs.get('shard_runner', run_shards_lambda)
+        failed = shard_runner(split_shards(hot_100, n_shards, previous, chart), shard_store, deadline=deadline) or []
+        merge_shards(hot_100, load_partials(shard_store, date, n_shards, chart, failed), cache, kwargs.get('metrics', None))
+    elif kwargs.get('concurrent', True):
+        enrich_concurrent(hot_100['data'], max_workers=kwargs.get('max_workers', MAX_WORKERS), cache=cache, deadline=deadline, previous=previous)
+    else:
+        enrich_sequential(hot_100['data'], cache=cache, deadline=deadline, previous=previous)
 
+    #Artist metadata is looked up once per unique artist on the chart, after the per-song lookups
+    if kwargs.get('artists', True):
+        enrich_artists(hot_100['data'], cache=cache, deadline=deadline)
+
+    n_unenriched = len([entry for entry in hot_100['data'] if 'unenriched' in entry])
+    if n_unenriched:
+        print(f"Ran short of time, {n_unenriched} songs were not fully enriched")
+
+    print(f"Lyrics providers: {json.dumps(get_lyrics_fetcher().summary())}")
+    if cache is not None:
+        print(f"Enrichment cache: {json.dumps(cache.stats())}")
+    if owns_cache:
+        cache.save()
+
+    lyrics_store = kwargs.get('lyrics_store', None)
+    upload_raw_week(hot_100, content_hash, kwargs.get('raw_format', None), lyrics_store, chart)
+
+    #With a RunMetrics passed in (see metrics), the run's figures are saved next to the week's raw file
+    run_metrics = kwargs.get('metrics', None)
+    if run_metrics is not None:
+        run_metrics.record('date', date, chart)
+        run_metrics.record('entries', len(hot_100['data']), chart)
+        run_metrics.record('unenriched', n_unenriched, chart)
+        run_metrics.record('lyrics_providers', get_lyrics_fetcher().summary())
+        if cache is not None:
+            run_metrics.record('enrichment_cache', cache.stats())
+        if lyrics_store is not None:
+            run_metrics.record('lyrics_blobs', lyrics_store.stats())
+        run_metrics.save(date, chart=chart)
+
+    if not date_string:
+        save_state({'etag': response.headers.get('ETag', ''), 'date': date}, chart=chart)
+
+#Pull several charts at once. They share one enrichment cache, saved once at the end, and concurrent
+#lookups of the same song are merged (see enrich.SingleFlight), so songs on several charts are fetched once
+def pull_charts(charts=None, **kwargs):
+    charts = charts or enabled_charts()
+    cache = kwargs.pop('cache', None)
+    owns_cache = (cache is None) and kwargs.get('use_cache', True)
+    if owns_cache:
+        cache = EnrichmentCache(S3CacheStore())
+
+    with ThreadPoolExecutor(max_workers=len(charts)) as executor:
+        futures = {chart: executor.submit(pull_data, chart=chart, cache=cache, **kwargs) for chart in charts}
+    failed = [chart for chart, future in futures.items() if future.exception() is not None]
+    if owns_cache:
+        cache.save()
+    for chart in failed:
+        print(f"Failed to pull {chart}: {futures[chart].exception()!r}")
+    if failed:
+        raise futures[failed[0]].exception()
+
+#Scheduled runs coordinate the week. Invocations carrying a shard payload are workers for one shard,
+#and finish within the coordinator's remaining budget as well as their own
 def lambda_handler(event, context):
-    pull_data()
\ No newline at end of file
+    deadline = Deadline.from_context(context)
+    event = event or {}
+    if 'budget_ms' in event.get('shard_payload', {}):
+        deadline = Deadline(min(context.get_remaining_time_in_millis(), event['shard_payload']['budget_ms']))
+    run_metrics = RunMetrics().start()
+    try:
+        if 'shard_payload' in event:
+            enrich_shard(event['shard_payload'], S3ShardStore(), deadline=deadline, metrics=run_metrics)
+        else:
+            pull_charts(event.get('charts', None), deadline=deadline, delta=True, n_shards=event.get('n_shards', N_SHARDS), metrics=run_metrics)
+    finally:
+        run_metrics.stop()
+        run_metrics.emit()
\ No newline at end of file
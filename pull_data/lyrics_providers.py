@@ -0,0 +1,205 @@
+import os
+import re
+import time
+import threading
+import requests
+from urllib.parse import quote_plus
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import http_client
+from normalize import memo
+from records import decode, LyricsPayload
+
+LYRIST_API_BASE = 'https://lyrist.vercel.app/api/'
+
+#Providers are tried in order. If a provider hasn't answered within HEDGE_PERCENTILE of its own
+#recent latencies, the next one is asked as well and the first answer with lyrics wins.
+#A local lyrics directory can be put in front by setting LYRICS_DIR.
+LYRICS_DIR = os.environ.get('LYRICS_DIR', None)
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_DELAY_DEFAULT = 1.
+HEDGE_DELAY_MIN = 0.1
+HEDGE_DELAY_MAX = 5.
+HEDGE_WORKERS = 16
+LATENCY_WINDOW = 200
+
+def lyrics_url(artist, song):
+    return LYRIST_API_BASE + f"/{quote_plus(artist)}/{quote_plus(song)}"
+
+#Every provider's fetch returns {'lyrics': ...}, {} when it has no lyrics for the song, or None when it failed
+class HTTPLyricsProvider:
+
+    #record is the shape of the provider's response (see records); None parses it in full
+    def __init__(self, name, build_url, lyrics_key='lyrics', record=LyricsPayload):
+        self.name = name
+        self.build_url = build_url
+        self.lyrics_key = lyrics_key
+        self.record = record
+
+    #Query variants (see normalize) are tried in turn until one finds lyrics
+    def fetch(self, entry, deadline=None, get=None):
+        for artist, song in memo.variants_for(entry, self.name):
+            try:
+                response = (get or http_client.get)(self.build_url(artist, song), deadline=deadline)
+                if response.status_code == 404:
+                    continue
+                response.raise_for_status()
+                payload = decode(response.content, self.record)
+            except (requests.RequestException, ValueError) as e:
+                print(f"Lyrics lookup ({self.name}) failed for {entry['song']} by {entry['artist']}: {e!r}")
+                return None
+            if self.lyrics_key in payload:
+                memo.put(entry['artist'], entry['song'], self.name, (artist, song))
+                return {'lyrics': payload[self.lyrics_key]}
+        return {}
+
+def lyrics_filename(artist, song):
+    return re.sub(r'[^a-z0-9]+', '_', f"{artist} - {song}".lower()).strip('_') + '.txt'
+
+class LocalLyricsProvider:
+
+    def __init__(self, directory, name='local'):
+        self.name = name
+        self.directory = directory
+
+    def fetch(self, entry, deadline=None, get=None):
+        path = os.path.join(self.directory, lyrics_filename(entry['artist'], entry['song']))
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='UTF-8') as f:
+            return {'lyrics': f.read()}
+
+class ProviderStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {'requests': 0, 'hits': 0, 'misses': 0, 'failures': 0, 'hedged': 0, 'wins': 0, 'abandoned': 0}
+
+    def record(self, result, elapsed):
+        with self.lock:
+            self.counts['requests'] += 1
+            if result is None:
+                self.counts['failures'] += 1
+                return
+            self.latencies.append(elapsed)
+            self.counts['hits' if result else 'misses'] += 1
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def percentile(self, q):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(q/100*len(latencies)))]
+
+    def summary(self):
+        with self.lock:
+            summary = dict(self.counts)
+            latencies = sorted(self.latencies)
+        answered = summary['hits'] + summary['misses']
+        summary['hit_rate'] = round(summary['hits']/answered, 3) if answered else 0.
+        if latencies:
+            summary['p50_ms'] = round(1000*latencies[len(latencies)//2], 1)
+            summary['p95_ms'] = round(1000*latencies[min(len(latencies) - 1, int(0.95*len(latencies)))], 1)
+        return summary
+
+class HedgedLyrics:
+
+    def __init__(self, providers):
+        self.providers = providers
+        self.stats = {provider.name: ProviderStats() for provider in providers}
+        self.executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+    def hedge_delay(self, provider):
+        delay = self.stats[provider.name].percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            return HEDGE_DELAY_DEFAULT
+        return min(HEDGE_DELAY_MAX, max(HEDGE_DELAY_MIN, delay))
+
+    def timed_fetch(self, provider, entry, deadline, get):
+        start = time.perf_counter()
+        result = provider.fetch(entry, deadline, get)
+        self.stats[provider.name].record(result, time.perf_counter() - start)
+        return result
+
+    def fetch(self, entry, deadline=None, get=None):
+        pending = {}
+        untried = list(self.providers)
+        not_found = False
+        failed = False
+
+        def launch():
+            provider = untried.pop(0)
+            pending[self.executor.submit(self.timed_fetch, provider, entry, deadline, get)] = provider
+            return provider
+
+        latest = launch()
+        while pending:
+            timeout = self.hedge_delay(latest) if untried else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            #Nobody answered in time, so ask the next provider too
+            if not done:
+                latest = launch()
+                self.stats[latest.name].count('hedged')
+                continue
+
+            for future in done:
+                provider = pending.pop(future)
+                result = future.result()
+                if result:
+                    self.stats[provider.name].count('wins')
+
+                    #Requests already on the wire can't be recalled, their answers are just dropped
+                    for other_future, other in pending.items():
+                        if not other_future.cancel():
+                            self.stats[other.name].count('abandoned')
+                    return result
+                if result is not None:
+                    not_found = True
+                else:
+                    failed = True
+
+                #This provider came back empty-handed, so move on without waiting for the hedge delay
+                if untried and (len(pending) == 0 or result is not None):
+                    latest = launch()
+
+        #Only a miss from every provider that answered, with none failing, counts as not found. Otherwise
+        #a miss in one provider during another's outage would be cached as a negative result
+        return {} if (not_found and not failed) else None
+
+    def summary(self):
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+def default_providers():
+    providers = [HTTPLyricsProvider('lyrist', lyrics_url)]
+    if LYRICS_DIR:
+        providers.insert(0, LocalLyricsProvider(LYRICS_DIR))
+    return providers
+
+_lyrics = None
+_lyrics_lock = threading.Lock()
+
+def get_lyrics_fetcher():
+    global _lyrics
+    with _lyrics_lock:
+        if _lyrics is None:
+            _lyrics = HedgedLyrics(default_providers())
+        return _lyrics
+
+def configure_providers(providers):
+    global _lyrics
+    with _lyrics_lock:
+        _lyrics = HedgedLyrics(providers)
+
+#Drops the fetcher and the latency history its hedge delays are based on; the next lookup starts a new one
+def reset_fetcher():
+    global _lyrics
+    with _lyrics_lock:
+        _lyrics = None
@@ -0,0 +1,178 @@
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+
+from enrich_cache import BUCKET
+
+#Lyrics are stored once under lyrics/<sha256 of the text> instead of inside every weekly file the song
+#charts in. Entries carry the hash in LYRICS_HASH_FIELD and readers resolve it back into 'lyrics'.
+#Blobs are gzip compressed unless LYRICS_CODEC=zstd, which needs zstandard wherever blobs are read: neither the
+#pull bundle nor the transform image ships it. Readers tell the codecs apart by their first bytes.
+#Turned on with LYRICS_BLOBS=1 so the pull Lambda can be switched over after the readers are deployed.
+#utilities/migrate_lyrics.py converts the weeks already in the lake
+LYRICS_BLOBS = os.environ.get('LYRICS_BLOBS', '0') == '1'
+LYRICS_PREFIX = 'lyrics/'
+LYRICS_HASH_FIELD = 'lyrics_sha256'
+LYRICS_CACHE_DIR = os.environ.get('LYRICS_CACHE_DIR', None)
+LYRICS_CODEC = os.environ.get('LYRICS_CODEC', 'gzip')
+LYRICS_CODECS = ['gzip', 'zstd']
+MAX_CACHED_BLOBS = 5000
+MAX_WORKERS = 16
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class LyricsBlobError(ValueError):
+    pass
+
+def check_codec(codec):
+    if codec not in LYRICS_CODECS:
+        raise LyricsBlobError(f"Unknown lyrics codec {codec!r}, expected one of {', '.join(LYRICS_CODECS)}")
+    if (codec == 'zstd') and (zstandard is None):
+        raise LyricsBlobError('LYRICS_CODEC is zstd but zstandard is not installed')
+    return codec
+
+def lyrics_hash(lyrics):
+    return hashlib.sha256(lyrics.encode('UTF-8')).hexdigest()
+
+def blob_key(lyrics_sha256):
+    return LYRICS_PREFIX + lyrics_sha256
+
+def compress_blob(lyrics, codec=LYRICS_CODEC):
+    if check_codec(codec) == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(lyrics.encode('UTF-8'))
+    return gzip.compress(lyrics.encode('UTF-8'), compresslevel=GZIP_LEVEL, mtime=0)
+
+def decompress_blob(body):
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    elif body[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise LyricsBlobError('Lyrics blob is zstd compressed but zstandard is not installed')
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body.decode('UTF-8')
+
+class LyricsBlobStore:
+
+    #Resolved blobs are kept in memory (least recently used dropped first) and, with a cache_dir,
+    #on local disk, so a reader going through many weeks fetches each song's lyrics once
+    #The codec is checked up front, so a misconfigured writer fails before it has written anything
+    def __init__(self, bucket=BUCKET, cache_dir=LYRICS_CACHE_DIR, max_cached=MAX_CACHED_BLOBS, codec=LYRICS_CODEC):
+        self.bucket = bucket
+        self.codec = check_codec(codec)
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        self.cached = OrderedDict()
+        self.known = set()
+        self.counters = {'hits': 0, 'fetched': 0, 'written': 0, 'existing': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def remember(self, lyrics_sha256, lyrics):
+        with self.lock:
+            self.known.add(lyrics_sha256)
+            self.cached[lyrics_sha256] = lyrics
+            self.cached.move_to_end(lyrics_sha256)
+            while len(self.cached) > self.max_cached:
+                self.cached.popitem(last=False)
+
+    #Hashes of every blob already in the bucket, so a bulk writer can skip the existence checks
+    def load_known(self):
+        client = boto3.client('s3')
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=LYRICS_PREFIX):
+            for object_info in page.get('Contents', []):
+                self.known.add(object_info['Key'][len(LYRICS_PREFIX):])
+
+    def exists(self, lyrics_sha256):
+        s3 = boto3.resource('s3')
+        try:
+            s3.Object(self.bucket, blob_key(lyrics_sha256)).load()
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+
+    #Stores the lyrics unless a blob with the same content is already there. Returns the hash
+    def put(self, lyrics):
+        lyrics_sha256 = lyrics_hash(lyrics)
+        with self.lock:
+            known = lyrics_sha256 in self.known
+        if known or self.exists(lyrics_sha256):
+            self.count('existing')
+        else:
+            s3 = boto3.resource('s3')
+            s3.Object(self.bucket, blob_key(lyrics_sha256)).put(Body=compress_blob(lyrics, self.codec), ContentType='application/octet-stream')
+            self.count('written')
+        self.remember(lyrics_sha256, lyrics)
+        return lyrics_sha256
+
+    def cache_path(self, lyrics_sha256):
+        return os.path.join(self.cache_dir, lyrics_sha256 + '.txt')
+
+    def get(self, lyrics_sha256):
+        with self.lock:
+            lyrics = self.cached.get(lyrics_sha256, None)
+        if lyrics is not None:
+            self.count('hits')
+            return lyrics
+
+        if self.cache_dir and os.path.exists(self.cache_path(lyrics_sha256)):
+            with open(self.cache_path(lyrics_sha256), encoding='UTF-8') as f:
+                lyrics = f.read()
+            self.count('hits')
+        else:
+            s3 = boto3.resource('s3')
+            lyrics = decompress_blob(s3.Object(self.bucket, blob_key(lyrics_sha256)).get()['Body'].read())
+            self.count('fetched')
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.cache_path(lyrics_sha256) + '.tmp', 'w', encoding='UTF-8') as f:
+                    f.write(lyrics)
+                os.replace(self.cache_path(lyrics_sha256) + '.tmp', self.cache_path(lyrics_sha256))
+        self.remember(lyrics_sha256, lyrics)
+        return lyrics
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['cached'] = len(self.cached)
+        return stats
+
+#Moves inline lyrics into the blob store, leaving the hash in their place. Returns the number of entries changed
+def externalize_lyrics(entries, store, max_workers=MAX_WORKERS):
+    inline = [entry for entry in entries if 'lyrics' in entry]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes = list(executor.map(lambda entry: store.put(entry['lyrics']), inline))
+    for entry, lyrics_sha256 in zip(inline, hashes):
+        del entry['lyrics']
+        entry[LYRICS_HASH_FIELD] = lyrics_sha256
+    return len(inline)
+
+#Puts the lyrics back on entries that only reference a blob, so they look like they always did
+def resolve_lyrics(entries, store, max_workers=MAX_WORKERS):
+    wanted = {entry[LYRICS_HASH_FIELD] for entry in entries if LYRICS_HASH_FIELD in entry}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resolved = dict(zip(wanted, executor.map(store.get, wanted)))
+    for entry in entries:
+        if LYRICS_HASH_FIELD in entry:
+            entry['lyrics'] = resolved[entry.pop(LYRICS_HASH_FIELD)]
+    return entries
+
+def uses_blobs(entries):
+    return any(LYRICS_HASH_FIELD in entry for entry in entries)
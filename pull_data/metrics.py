@@ -0,0 +1,114 @@
+import json
+import time
+import threading
+import boto3
+
+import http_client
+from enrich_cache import BUCKET
+from charts import DEFAULT_CHART
+
+#Per-run instrumentation of the pull path. Every upstream attempt is observed through http_client.observers
+#and counted per upstream: requests, status codes, exceptions, bytes received and a latency histogram.
+#Each run's summary is printed as one JSON line (easy to query in CloudWatch Logs Insights) and saved
+#under metrics/ with the same name as the week's raw file, so throughput can be compared week to week.
+#They don't go under data/ because everything there is read as a raw week
+METRICS_PREFIX = 'metrics/'
+METRICS_EVENT = 'pull_data_metrics'
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+def empty_upstream():
+    return {'requests': 0, 'errors': 0, 'bytes': 0, 'status': {}, 'exceptions': {},
+            'latency_ms_sum': 0., 'latency_ms_max': 0., 'histogram': [0]*(len(LATENCY_BUCKETS_MS) + 1)}
+
+#Latency at the q-th percentile, as the upper bound of the histogram bucket it falls in
+def histogram_percentile(histogram, q):
+    total = sum(histogram)
+    if total == 0:
+        return None
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS + [None], histogram):
+        seen += count
+        if seen >= q/100*total:
+            return bound
+    return None
+
+class RunMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.upstreams = {}
+        self.values = {}
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        http_client.observers.append(self.observe)
+        return self
+
+    def stop(self):
+        if self.observe in http_client.observers:
+            http_client.observers.remove(self.observe)
+        self.values['elapsed_s'] = round(time.perf_counter() - self.started, 3)
+
+    def observe(self, upstream, url, response, error, elapsed):
+        elapsed_ms = 1000*elapsed
+        bucket = len([bound for bound in LATENCY_BUCKETS_MS if elapsed_ms > bound])
+        with self.lock:
+            counts = self.upstreams.setdefault(upstream, empty_upstream())
+            counts['requests'] += 1
+            counts['latency_ms_sum'] += elapsed_ms
+            counts['latency_ms_max'] = max(counts['latency_ms_max'], elapsed_ms)
+            counts['histogram'][bucket] += 1
+            if response is None:
+                counts['errors'] += 1
+                name = type(error).__name__
+                counts['exceptions'][name] = counts['exceptions'].get(name, 0) + 1
+            else:
+                status = str(response.status_code)
+                counts['status'][status] = counts['status'].get(status, 0) + 1
+                counts['bytes'] += len(response.content or b'')
+
+    #Run-level values: entry counts, cache statistics and the like. Values for one chart are kept
+    #under 'charts', since a run can pull several charts at once
+    def record(self, name, value, chart=None):
+        with self.lock:
+            if chart is None:
+                self.values[name] = value
+            else:
+                self.values.setdefault('charts', {}).setdefault(chart, {})[name] = value
+
+    #Fold in the upstream counts from another run's summary, e.g. a shard worker's
+    def merge(self, summary):
+        with self.lock:
+            for upstream, other in summary.get('upstreams', {}).items():
+                counts = self.upstreams.setdefault(upstream, empty_upstream())
+                for name in ['requests', 'errors', 'bytes', 'latency_ms_sum']:
+                    counts[name] += other[name]
+                counts['latency_ms_max'] = max(counts['latency_ms_max'], other['latency_ms_max'])
+                counts['histogram'] = [a + b for a, b in zip(counts['histogram'], other['histogram'])]
+                for name in ['status', 'exceptions']:
+                    for key, count in other[name].items():
+                        counts[name][key] = counts[name].get(key, 0) + count
+
+    def summary(self):
+        with self.lock:
+            upstreams = json.loads(json.dumps(self.upstreams))
+            values = json.loads(json.dumps(self.values))
+        if (self.started is not None) and ('elapsed_s' not in values):
+            values['elapsed_s'] = round(time.perf_counter() - self.started, 3)
+        for counts in upstreams.values():
+            counts['latency_ms_mean'] = round(counts['latency_ms_sum']/counts['requests'], 1) if counts['requests'] else 0.
+            counts['latency_ms_p50'] = histogram_percentile(counts['histogram'], 50)
+            counts['latency_ms_p95'] = histogram_percentile(counts['histogram'], 95)
+            counts['latency_ms_sum'] = round(counts['latency_ms_sum'], 1)
+            counts['latency_ms_max'] = round(counts['latency_ms_max'], 1)
+        summary = {'event': METRICS_EVENT, 'histogram_bounds_ms': LATENCY_BUCKETS_MS, 'upstreams': upstreams}
+        summary.update(values)
+        return summary
+
+    def emit(self):
+        print(json.dumps(self.summary()))
+
+    def save(self, date, bucket=BUCKET, chart=DEFAULT_CHART):
+        s3 = boto3.resource('s3')
+        s3.Object(bucket, f"{METRICS_PREFIX}{chart}-{date}.json").put(Body=json.dumps(self.summary()).encode('UTF-8'))
@@ -0,0 +1,71 @@
+import re
+import threading
+
+from enrich_cache import normalize_key
+
+#Chart credits and titles often don't match what Last.fm and lyrist index ("A Featuring B",
+#"Song (From The Movie)", "Song (Remix)"), and every miss costs a round trip. Lookups try a short
+#ranked list of query variants and remember which one worked for each song and upstream.
+MAX_VARIANTS = 3
+#Separators between credited artists. Nothing inside parentheses or brackets is split ("Silk Sonic (Bruno Mars &
+#Anderson .Paak)" is one act), nor a comma before "The" ("Tyler, The Creator")
+FEATURE_SPLIT = r'(?:\s+(?:featuring|feat\.?|ft\.?|with|x)\s+|\s*&\s*|\s*,(?!\s*the\b)\s*)(?![^\(\[]*[\)\]])'
+TITLE_TAGS = r'\s*[\(\[][^\)\]]*(?:feat|remix|version|edit|mix|from|live|remaster)[^\)\]]*[\)\]]'
+
+def primary_artist(artist):
+    return re.split(FEATURE_SPLIT, artist, maxsplit=1, flags=re.IGNORECASE)[0].strip()
+
+def clean_title(song):
+    song = re.sub(TITLE_TAGS, '', song, flags=re.IGNORECASE)
+    song = re.sub(r'\s+-\s+.*(?:remix|version|edit|mix|live|remaster).*$', '', song, flags=re.IGNORECASE)
+    return re.sub(r'\s+', ' ', song).strip()
+
+#Ranked (artist, song) pairs to query, best guess first and without duplicates
+def query_variants(artist, song, preferred=None):
+    candidates = [(artist, song), (primary_artist(artist), song),
+                  (primary_artist(artist), clean_title(song)), (artist, clean_title(song))]
+    if preferred is not None:
+        candidates.insert(0, tuple(preferred))
+
+    variants = []
+    for candidate in candidates:
+        if candidate[0] and candidate[1] and (candidate not in variants):
+            variants.append(candidate)
+    return variants[:MAX_VARIANTS]
+
+class VariantMemo:
+
+    #Which query variant answered for each (artist, song) and upstream. Kept in memory for the run
+    #and, once a cache is attached, persisted in the enrichment cache so later weeks hit first time
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.variants = {}
+        self.cache = None
+
+    def use_cache(self, cache):
+        self.cache = cache
+
+    def reset(self):
+        with self.lock:
+            self.variants = {}
+        self.cache = None
+
+    def get(self, artist, song, upstream):
+        with self.lock:
+            variant = self.variants.get((normalize_key(artist, song), upstream), None)
+        if (variant is None) and (self.cache is not None):
+            fields = self.cache.peek(artist, song, 'query_' + upstream)
+            if fields:
+                variant = fields['query']
+        return variant
+
+    def put(self, artist, song, upstream, variant):
+        with self.lock:
+            self.variants[(normalize_key(artist, song), upstream)] = list(variant)
+        if (self.cache is not None) and (tuple(variant) != (artist, song)):
+            self.cache.put(artist, song, 'query_' + upstream, {'query': list(variant)})
+
+    def variants_for(self, entry, upstream):
+        return query_variants(entry['artist'], entry['song'], self.get(entry['artist'], entry['song'], upstream))
+
+memo = VariantMemo()
@@ -0,0 +1,94 @@
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import boto3
+
+from enrich_cache import BUCKET
+from chart_state import raw_week_key, HASH_METADATA
+from charts import DEFAULT_CHART
+from raw_reader import FORMAT_METADATA, SHA256_METADATA, COUNT_METADATA, NDJSON_HEADER, NDJSON_VERSION, decode_raw_week
+from lake_manifest import record_weeks, week_record
+
+#Raw weeks can be written as compressed NDJSON instead of one JSON document: a header record with the
+#chart's top-level fields, then one entry per line. The body is compressed while it is written, spooled
+#(in memory up to SPOOL_MAX_BYTES, then to disk) and handed to s3transfer, which switches to a
+#multipart upload for large bodies. Keys stay data/hot-100-<date>.json so listings are unchanged;
+#readers tell the formats apart by their first bytes (see raw_reader, which the transform has a copy of).
+#RAW_FORMAT is 'json' (the original format), 'ndjson+gzip' or 'ndjson+zstd'
+RAW_FORMAT = os.environ.get('RAW_FORMAT', 'json')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+SPOOL_MAX_BYTES = 8*1024*1024
+MULTIPART_BYTES = 8*1024*1024
+
+#zstandard isn't vendored into the pull bundle. Without it zstd writes fall back to gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def ndjson_lines(hot_100):
+    header = {key: value for key, value in hot_100.items() if key != 'data'}
+    header.update({'format': NDJSON_HEADER, 'version': NDJSON_VERSION, 'entries': len(hot_100['data'])})
+    yield (json.dumps(header) + '\n').encode('UTF-8')
+    for entry in hot_100['data']:
+        yield (json.dumps(entry) + '\n').encode('UTF-8')
+
+def compressor(raw_format, f):
+    if raw_format == 'ndjson+zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=False)
+    return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+
+#Compresses the NDJSON into a spooled file, hashing the uncompressed lines on the way.
+#Returns the rewound file and the metadata describing its contents
+def encode_ndjson(hot_100, raw_format):
+    if (raw_format == 'ndjson+zstd') and (zstandard is None):
+        raw_format = 'ndjson+gzip'
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    digest = hashlib.sha256()
+    stream = compressor(raw_format, spool)
+    for line in ndjson_lines(hot_100):
+        digest.update(line)
+        stream.write(line)
+    stream.close()
+    spool.seek(0)
+    return spool, {FORMAT_METADATA: raw_format, SHA256_METADATA: digest.hexdigest(), COUNT_METADATA: str(len(hot_100['data']))}
+
+#Upload a raw week, tagged with the hash of the chart it was built from
+def write_raw_week(hot_100, metadata, raw_format=None, bucket=BUCKET, chart=DEFAULT_CHART):
+    raw_format = raw_format or RAW_FORMAT
+    key = raw_week_key(hot_100['date'], chart)
+    metadata = {name: value for name, value in metadata.items() if name not in (FORMAT_METADATA, SHA256_METADATA, COUNT_METADATA)}
+    if raw_format == 'json':
+        s3 = boto3.resource('s3')
+        body = json.dumps(hot_100).encode('UTF-8')
+        response = s3.Object(bucket, key).put(Body=body, Metadata=metadata)
+        record_weeks({key: week_record(key, raw_format, len(body), hashlib.sha256(body).hexdigest(), len(hot_100['data']),
+                                       response.get('ETag', None))}, bucket)
+        return
+
+    #s3transfer pulls in multiprocessing, so it is only imported by runs that use it (see utilities/build_pull_bundle.py)
+    from boto3.s3.transfer import TransferConfig
+    config = TransferConfig(multipart_threshold=MULTIPART_BYTES, multipart_chunksize=MULTIPART_BYTES)
+    body, ndjson_metadata = encode_ndjson(hot_100, raw_format)
+    metadata.update(ndjson_metadata)
+    with body:
+        size = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        boto3.client('s3').upload_fileobj(body, bucket, key, ExtraArgs={'Metadata': metadata}, Config=config)
+
+    #upload_fileobj doesn't return the ETag, which is left for utilities/reconcile_lake.py to fill in
+    record_weeks({key: week_record(key, ndjson_metadata[FORMAT_METADATA], size, ndjson_metadata[SHA256_METADATA],
+                                   len(hot_100['data']))}, bucket)
+
+def upload_raw_week(hot_100, content_hash, raw_format=None, bucket=BUCKET, chart=DEFAULT_CHART):
+    write_raw_week(hot_100, {HASH_METADATA: content_hash}, raw_format, bucket, chart)
+
+#Returns the week as the usual {'date': ..., 'data': [...]} dict along with the object's metadata
+def load_raw_week(key, bucket=BUCKET, record=None):
+    s3 = boto3.resource('s3')
+    response = s3.Object(bucket, key).get()
+    metadata = response.get('Metadata', {})
+    return decode_raw_week(response['Body'], metadata, record), metadata
@@ -0,0 +1,107 @@
+import gzip
+import hashlib
+
+from records import decode, entry_record
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Reading raw weeks, whichever format they were written in (see pull_data/raw_lake.py): one JSON document, or
+#compressed NDJSON (a header record, then one entry per line) that is decompressed and decoded as a stream and
+#checked against the entry count and hash in the object's metadata.
+#Both Lambdas use this: transform_data_package/image/src/raw_reader.py is a copy of this file, keep them the same
+FORMAT_METADATA = 'raw-format'
+SHA256_METADATA = 'raw-sha256'
+COUNT_METADATA = 'entry-count'
+NDJSON_HEADER = 'hot-100-ndjson'
+NDJSON_VERSION = 1
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+READ_CHUNK = 64*1024
+
+class RawWeekError(ValueError):
+    pass
+
+#S3 bodies can't be peeked, so the bytes read to sniff the format are put back in front of the stream
+class PrefixedStream:
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read() if (size is None or size < 0) else self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+#Wraps a readable stream so it yields the decompressed bytes, whatever format the week was written in.
+#Returns the stream and whether it holds NDJSON
+def open_raw_stream(stream):
+    magic = stream.read(4)
+    stream = PrefixedStream(magic, stream)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream, mode='rb'), True
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RawWeekError('Raw week is zstd compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().stream_reader(stream), True
+    return stream, False
+
+def iter_lines(stream):
+    pending = b''
+    while True:
+        chunk = stream.read(READ_CHUNK)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+#Yields the header record and then each entry, checking the entry count and content hash at the end
+#when the object's metadata carries them. Plain JSON weeks are loaded whole and yielded the same way.
+#With a week record (see records.Week) entries are cut down to its fields; the hash still covers every byte
+def iter_raw_week(stream, metadata=None, record=None):
+    metadata = metadata or {}
+    stream, is_ndjson = open_raw_stream(stream)
+    if not is_ndjson:
+        hot_100 = decode(stream.read(), record)
+        yield {key: value for key, value in hot_100.items() if key != 'data'}
+        yield from hot_100['data']
+        return
+
+    digest = hashlib.sha256()
+    n_entries = -1
+    line_record = None
+    for line in iter_lines(stream):
+        digest.update(line)
+        entry = decode(line, line_record)
+        if n_entries < 0:
+            if entry.get('format', None) != NDJSON_HEADER:
+                raise RawWeekError('Raw week does not start with an NDJSON header record')
+            line_record = entry_record(record) if record else None
+        n_entries += 1
+        yield entry
+
+    if (COUNT_METADATA in metadata) and (int(metadata[COUNT_METADATA]) != n_entries):
+        raise RawWeekError(f"Raw week has {n_entries} entries, metadata says {metadata[COUNT_METADATA]}")
+    if (SHA256_METADATA in metadata) and (metadata[SHA256_METADATA] != digest.hexdigest()):
+        raise RawWeekError('Raw week content does not match the hash in its metadata')
+
+def decode_raw_week(stream, metadata=None, record=None):
+    records = iter_raw_week(stream, metadata, record)
+    hot_100 = next(records)
+    for name in ('format', 'version', 'entries'):
+        hot_100.pop(name, None)
+    hot_100['data'] = list(records)
+    return hot_100
@@ -0,0 +1,80 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+import http_client
+
+#Record/replay for the pull path. Recording saves every upstream response into a cassette directory,
+#one JSON file per request. Replaying points http_client at utilities/mock_upstream.py, which serves them back.
+SCRUBBED_PARAMS = ['api_key']
+RECORDED_HEADERS = ['Content-Type', 'ETag', 'Retry-After']
+
+def scrub_query(query):
+    for param in SCRUBBED_PARAMS:
+        query = re.sub(rf'(^|&){param}=[^&]*', rf'\1{param}=REDACTED', query)
+    return query
+
+#Requests are matched on host, path and query (with secrets scrubbed), ignoring the scheme
+def cassette_key(url):
+    parsed = urlparse(url)
+    key = parsed.netloc + parsed.path
+    if parsed.query:
+        key += '?' + scrub_query(parsed.query)
+    return key
+
+class Cassette:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('UTF-8')).hexdigest()[:32] + '.json')
+
+    def save(self, url, response):
+        key = cassette_key(url)
+        record = {'key': key, 'status': response.status_code,
+                  'headers': {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers},
+                  'body': response.text}
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(key), 'w') as f:
+                json.dump(record, f)
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def keys(self):
+        keys = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(self.directory, name)) as f:
+                    keys.append(json.load(f)['key'])
+        return keys
+
+#Retryable failures are not recorded, so a cassette holds the answers the pull path finally used
+def start_recording(directory):
+    cassette = Cassette(directory)
+
+    def observer(upstream, url, response, error, elapsed):
+        if (response is not None) and (response.status_code not in http_client.RETRY_STATUS):
+            cassette.save(response.request.url, response)
+
+    http_client.observers.append(observer)
+    return observer
+
+def stop_recording(observer):
+    http_client.observers.remove(observer)
+
+def start_replay(base_url):
+    http_client.REDIRECT_BASE = base_url
+
+def stop_replay():
+    http_client.REDIRECT_BASE = None
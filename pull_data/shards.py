@@ -0,0 +1,155 @@
+import os
+import json
+import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from enrich import enrich_concurrent, apply_fields
+from enrich_cache import EnrichmentCache, S3CacheStore, BUCKET
+from delta import index_entries
+from normalize import memo
+from charts import DEFAULT_CHART
+
+#Sharded enrichment: the coordinator splits a week's entries into shards, each worker enriches one
+#shard and writes it as a partial result, and the coordinator merges the partials back in chart order.
+#Workers split each upstream's rate limit between them, since they don't share token buckets.
+#A shard whose worker fails or runs past the coordinator's deadline is merged back unenriched, so the week is still uploaded.
+SHARD_PREFIX = 'shards/'
+PULL_FUNCTION_NAME = 'pull_data'
+#Longest a Lambda invocation can run
+MAX_INVOKE_SECONDS = 900
+
+def shard_name(date, shard, n_shards, chart=DEFAULT_CHART):
+    if chart != DEFAULT_CHART:
+        return f"{chart}/{date}/{shard}-of-{n_shards}.json"
+    return f"{date}/{shard}-of-{n_shards}.json"
+
+#Entries are dealt out round robin so every shard gets a similar mix of chart positions
+def split_shards(hot_100, n_shards, previous=None, chart=DEFAULT_CHART):
+    payloads = []
+    for shard in range(n_shards):
+        indices = list(range(shard, len(hot_100['data']), n_shards))
+        entries = [hot_100['data'][i] for i in indices]
+        payload = {'date': hot_100['date'], 'chart': chart, 'shard': shard, 'n_shards': n_shards, 'indices': indices, 'entries': entries}
+        if previous is not None:
+            matched = [previous[key] for key in index_entries(entries) if key in previous]
+            payload['previous'] = matched
+        payloads.append(payload)
+    return payloads
+
+class LocalShardStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, name, payload):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(payload, f)
+
+    def get(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return json.load(f)
+
+class S3ShardStore:
+
+    def __init__(self, bucket=BUCKET, prefix=SHARD_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, name, payload):
+        s3 = boto3.resource('s3')
+        s3.Object(self.bucket, self.prefix + name).put(Body=json.dumps(payload).encode('UTF-8'))
+
+    def get(self, name):
+        s3 = boto3.resource('s3')
+        return json.loads(s3.Object(self.bucket, self.prefix + name).get()['Body'].read().decode('UTF-8'))
+
+#Enrich one shard and write it to the store. New cache records go back with the partial result,
+#because several workers saving the shared cache at once would overwrite each other
+#A worker's upstream metrics are sent back the same way and merged into the coordinator's
+#The rate share only lasts for the shard, so a warm container that coordinates next gets full rates back
+def enrich_shard(payload, store, use_cache=True, deadline=None, metrics=None):
+    cache = EnrichmentCache(S3CacheStore()) if use_cache else None
+    if cache is not None:
+        memo.use_cache(cache)
+    previous = index_entries(payload['previous']) if 'previous' in payload else None
+
+    rate_share = http_client.RATE_SHARE
+    http_client.set_rate_share(1/payload['n_shards'])
+    try:
+        enrich_concurrent(payload['entries'], cache=cache, deadline=deadline, previous=previous)
+    finally:
+        http_client.set_rate_share(rate_share)
+
+    partial = {key: payload[key] for key in ['date', 'shard', 'n_shards', 'indices', 'entries']}
+    partial['cache_updates'] = cache.updates() if cache is not None else {}
+    if metrics is not None:
+        partial['metrics'] = metrics.summary()
+    store.put(shard_name(payload['date'], payload['shard'], payload['n_shards'], payload.get('chart', DEFAULT_CHART)), partial)
+
+#Shards listed in failed have no partial result and are left out
+def load_partials(store, date, n_shards, chart=DEFAULT_CHART, failed=()):
+    return [store.get(shard_name(date, shard, n_shards, chart)) for shard in range(n_shards) if shard not in failed]
+
+#Put every enriched entry back at its original position and fold the workers' cache updates in.
+#Entries no partial result covers are marked unenriched so they can be filled in later
+def merge_shards(hot_100, partials, cache=None, metrics=None):
+    data = list(hot_100['data'])
+    merged = set()
+    for partial in partials:
+        for index, entry in zip(partial['indices'], partial['entries']):
+            data[index] = entry
+            merged.add(index)
+        if cache is not None:
+            cache.merge(partial['cache_updates'])
+        if (metrics is not None) and ('metrics' in partial):
+            metrics.merge(partial['metrics'])
+    for index, entry in enumerate(data):
+        if index not in merged:
+            for source in ['track', 'lyrics']:
+                apply_fields(entry, None, source)
+    hot_100['data'] = data
+    return hot_100
+
+def set_redirect(redirect_base):
+    http_client.REDIRECT_BASE = redirect_base
+
+#Runners take the shard payloads and a store, and return once every partial result has been written or
+#given up on, with the list of shards that have none. Lambda workers always write to the S3 shard store
+def run_shards_local(payloads, store, processes=None, use_cache=False, redirect_base=None, deadline=None):
+    #Only used off Lambda, so process pools aren't imported at cold start
+    from concurrent.futures import ProcessPoolExecutor
+    initargs = (redirect_base,)
+    with ProcessPoolExecutor(max_workers=processes or len(payloads), initializer=set_redirect, initargs=initargs) as executor:
+        futures = [executor.submit(enrich_shard, payload, store, use_cache, deadline) for payload in payloads]
+        for future in futures:
+            future.result()
+    return []
+
+#Workers get the coordinator's remaining budget in their payload (budget_ms) and stop by then, and each invoke is
+#given up on at the coordinator's deadline. Invokes are never retried: a timed out worker may still be running,
+#and a retry would enrich the same shard again
+def run_shards_lambda(payloads, store=None, function_name=PULL_FUNCTION_NAME, deadline=None):
+    read_timeout = max(1, int(deadline.remaining())) if deadline is not None else MAX_INVOKE_SECONDS
+    client = boto3.client('lambda', config=Config(read_timeout=read_timeout, retries={'max_attempts': 0}))
+
+    def invoke(payload):
+        if deadline is not None:
+            payload = dict(payload, budget_ms=int(deadline.remaining()*1000))
+        try:
+            response = client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
+                                     Payload=json.dumps({'shard_payload': payload}).encode('UTF-8'))
+        except Exception as e:
+            print(f"Shard {payload['shard']} failed, merging it unenriched: {e!r}")
+            return False
+        if 'FunctionError' in response:
+            print(f"Shard {payload['shard']} failed, merging it unenriched: {response['Payload'].read().decode('UTF-8')}")
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+        succeeded = list(executor.map(invoke, payloads))
+    return [payload['shard'] for payload, ok in zip(payloads, succeeded) if not ok]
@@ -1,10 +1,11 @@
+import os
 import boto3
-import json
+import gzip
 import re
 import numpy as np
 import pandas as pd
-import io
 from datetime import datetime
+from urllib.parse import unquote_plus
 from collections import Counter
 from nrclex import NRCLex
 from langdetect import detect
@@ -14,6 +15,15 @@ from nltk.probability import FreqDist
 from nltk.stem import WordNetLemmatizer
 from nltk.data import path
 from nltk import download
+from records import Week
+from raw_reader import decode_raw_week
+from table_store import PartitionedTables, LONG_COLUMNS
+
+#Only needed for lyrics blobs written with LYRICS_CODEC=zstd (see pull_data/lyrics_store.py)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #Put nltk downloads in Lambda emphemeral storage
 download('stopwords', download_dir='/tmp')
@@ -24,6 +34,36 @@ path.append("/tmp")
 STOP_WORDS = set(stopwords.words('english'))
 BUCKET = 'what-are-we-singing-about'
 
+#Lyrics may be stored once under lyrics/<sha256> with entries only holding the hash (see pull_data/lyrics_store.py).
+#Blobs are cached in the Lambda's ephemeral storage so warm invocations don't fetch them again
+LYRICS_CACHE_DIR = '/tmp/lyrics'
+
+def read_lyrics_blob(s3, lyrics_sha256):
+    path = os.path.join(LYRICS_CACHE_DIR, lyrics_sha256 + '.txt')
+    if os.path.exists(path):
+        with open(path, encoding='UTF-8') as f:
+            return f.read()
+
+    body = s3.Object(BUCKET, 'lyrics/' + lyrics_sha256).get()['Body'].read()
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    elif body[:4] == b'\x28\xb5\x2f\xfd':
+        if zstandard is None:
+            raise ValueError(f"Lyrics blob {lyrics_sha256} is zstd compressed but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    lyrics = body.decode('UTF-8')
+
+    os.makedirs(LYRICS_CACHE_DIR, exist_ok=True)
+    with open(path, 'w', encoding='UTF-8') as f:
+        f.write(lyrics)
+    return lyrics
+
+def resolve_lyrics(s3, hot_100):
+    for entry in hot_100['data']:
+        if 'lyrics_sha256' in entry:
+            entry['lyrics'] = read_lyrics_blob(s3, entry.pop('lyrics_sha256'))
+    return hot_100
+
 def make_df(hot_100_weekly):
 
     #Initialize objects for grabbing overall word/tag frequencies and emotions
@@ -104,14 +144,17 @@ def make_df(hot_100_weekly):
         entry_new['n_words'] = n_words
         data.append(entry_new)
 
+    #Weeks with no English lyrics (album charts never have any) get no word frequencies and NaN emotions
     word_fd_avg = {}
-    top_100_words = dict(counter_word_fd_total.most_common(100))
-    for key in top_100_words:
-        word_fd_avg[key] = top_100_words[key]/n_songs_lyrics_analyzed
-
     affect_fq_avg = {}
-    for key in counter_affect_fq:
-        affect_fq_avg[key] = counter_affect_fq[key]/n_songs_lyrics_analyzed
+    if n_songs_lyrics_analyzed > 0:
+        top_100_words = dict(counter_word_fd_total.most_common(100))
+        for key in top_100_words:
+            word_fd_avg[key] = top_100_words[key]/n_songs_lyrics_analyzed
+        for key in counter_affect_fq:
+            affect_fq_avg[key] = counter_affect_fq[key]/n_songs_lyrics_analyzed
+    else:
+        affect_fq_avg = {key: np.nan for key in affect_fq_total}
 
     hot_100_product['n_songs_lyrics_analyzed'] = n_songs_lyrics_analyzed
     hot_100_product['tag_fd'] = dict(tag_fd_total.most_common(50))
@@ -131,6 +174,8 @@ def make_df(hot_100_weekly):
 def calc_confidence_wings(data, frac):
     sorted = np.sort(data[~np.isnan(data)])
     n_meas = len(sorted)
+    if n_meas == 0:
+        return np.nan, np.nan
     loc_low = np.argmin(np.abs(np.arange(n_meas) - (1 - frac)*n_meas))
     loc_high = np.argmin(np.abs(np.arange(n_meas) - frac*n_meas))
 
@@ -153,43 +198,34 @@ def extract_features(hot_100_product):
     df['err_weeks_low'] = 0.
     df['err_weeks_high'] = 0.
 
-    df_artist_pop = df['date'].copy().to_frame()
-    df_word_freq = df['date'].copy().to_frame()
+    #Artist popularity and word frequency are long tables, one (date, key, value) row per artist or word
+    #that week, since any one week only has a small part of all the artists and words ever seen
+    artist_pop_rows = []
+    word_freq_rows = []
     df_emotion = df['date'].copy().to_frame()
     for i in range(n_weeks):
         songs = df.iloc[i]['song']
         artists = df.iloc[i]['artist']
         this_week = df.iloc[i]['this_week']
         peak_position = df.iloc[i]['peak_position']
-        artist_list = []
+        artist_pop = Counter()
 
         #Grab artist in seperate list for counting popularity. If multiple artists, count both
         #Popularity is counted as 101 - chart position for each charting song
         for j in range(len(songs)):
             if ("&" in artists[j]):
-                artist_split = re.split("&", artists[j])
-                for name in artist_split:
-                    if name not in df_artist_pop.columns:
-                        df_artist_pop[name.strip()] = 0.
-                    df_artist_pop.iloc[i, df_artist_pop.columns.get_loc(name.strip())] += (101 - this_week[j])
+                names = [name.strip() for name in re.split("&", artists[j])]
             elif ("featuring" in artists[j].lower()):
-                artist_split = re.split("featuring", artists[j], flags=re.IGNORECASE)
-                for name in artist_split:
-                    if name not in df_artist_pop.columns:
-                        df_artist_pop[name.strip()] = 0.
-                    df_artist_pop.iloc[i, df_artist_pop.columns.get_loc(name.strip())] += (101 - this_week[j])
+                names = [name.strip() for name in re.split("featuring", artists[j], flags=re.IGNORECASE)]
             else:
-                if artists[j] not in df_artist_pop.columns:
-                    df_artist_pop[artists[j]] = 0.
-                df_artist_pop.iloc[i, df_artist_pop.columns.get_loc(artists[j])] += (101 - this_week[j])
-            
+                names = [artists[j]]
+            for name in names:
+                artist_pop[name] += float(101 - this_week[j])
+        artist_pop_rows += [(df.index[i], df.iloc[i]['date'], name, score) for name, score in artist_pop.items()]
+
         #Grab other weekly metrics
         word_fd = df.iloc[i]['word_fd_avg']
-        for key in word_fd:
-            if (key != ''):
-                if key not in df_word_freq.columns:
-                    df_word_freq[key] = 0.
-                df_word_freq.iloc[i, df_word_freq.columns.get_loc(key)] = float(word_fd[key])
+        word_freq_rows += [(df.index[i], df.iloc[i]['date'], key, float(word_fd[key])) for key in word_fd if (key != '')]
         emotion_fq = df.iloc[i]['affect_fq_avg']
         for key in emotion_fq:
             if key not in df_emotion.columns:
@@ -225,12 +261,38 @@ def extract_features(hot_100_product):
     df['err_wpm_low'] = df['err_wpm_low']*60000
     df['err_wpm_high'] = df['err_wpm_high']*60000
 
+    df_artist_pop = long_table(artist_pop_rows)
+    df_word_freq = long_table(word_freq_rows)
     return df, df_artist_pop, df_word_freq, df_emotion
 
+#Rows of (index, date, key, value). The index is the week, as in the other tables
+def long_table(rows):
+    index = [row[0] for row in rows]
+    return pd.DataFrame([row[1:] for row in rows], columns=LONG_COLUMNS, index=index)
+
+#Each chart (see pull_data/charts.py) has its own raw weeks, data/<chart>-<date>.json, and its own tables
+#(see table_store.py)
+DEFAULT_CHART = 'hot-100'
+
+#The raw week that triggered this run, from the S3 event, or today's Hot 100 when invoked without one
+def raw_week_from_event(event):
+    records = (event or {}).get('Records', [])
+    if records:
+        return unquote_plus(records[0]['s3']['object']['key'])
+    return f"data/{DEFAULT_CHART}-{datetime.today().date()}.json"
+
 def lambda_handler(event, context):
     s3 = boto3.resource('s3')
-    obj = s3.Object(BUCKET, f"data/hot-100-{datetime.today().date()}.json")
-    hot_100 = json.loads(obj.get()['Body'].read().decode('UTF-8'))
+    raw_key = raw_week_from_event(event)
+    match = re.fullmatch(r'data/(.+)-(\d{4}-\d{2}-\d{2})\.json', raw_key)
+    if match is None:
+        print(f"{raw_key} is not a raw week, nothing to transform")
+        return
+    chart = match.group(1)
+    #Raw weeks are decoded as a stream and checked against the entry count and hash in their metadata.
+    #Only the fields make_df uses are kept (see records.Week)
+    response = s3.Object(BUCKET, raw_key).get()
+    hot_100 = resolve_lyrics(s3, decode_raw_week(response['Body'], response.get('Metadata', {}), Week))
 
     #Extract/transform functions are set up to make it easy to extract multiple weeks' worth of data at a time
     #But in this script we are just extracting one week at a time
@@ -241,40 +303,8 @@ def lambda_handler(event, context):
     hot_100_all[dt_formatted] = hot_100_product
     df_final_today, df_artist_pop_today, df_word_freq_today, df_emotion_today = extract_features(hot_100_all)
 
-    #Append this week to tables
-    df_final = pd.read_json(io.BytesIO(s3.Object('what-are-we-singing-about', 'df_final.json').get()['Body'].read()))
-    df_artist_pop = pd.read_json(io.BytesIO(s3.Object('what-are-we-singing-about', 'df_artist_pop.json').get()['Body'].read()))
-    df_word_freq = pd.read_json(io.BytesIO(s3.Object('what-are-we-singing-about', 'df_word_freq.json').get()['Body'].read()))
-    df_emotion = pd.read_json(io.BytesIO(s3.Object('what-are-we-singing-about', 'df_emotion.json').get()['Body'].read()))
-
-    key = 'df_final.json'
-    obj = s3.Object(BUCKET, key)
-    df = pd.read_json(io.BytesIO(obj.get()['Body'].read()))
-    df = pd.concat([df_final, pd.DataFrame(df_final_today)]).fillna(0)
-    json_buffer = io.StringIO()
-    df.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key=key, Body=json_buffer.getvalue())
-
-    key = 'df_artist_pop.json'
-    obj = s3.Object(BUCKET, key)
-    df = pd.read_json(io.BytesIO(obj.get()['Body'].read()))
-    df = pd.concat([df_artist_pop, pd.DataFrame(df_artist_pop_today)]).fillna(0)
-    json_buffer = io.StringIO()
-    df.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key=key, Body=json_buffer.getvalue())
-
-    key = 'df_word_freq.json'
-    obj = s3.Object(BUCKET, key)
-    df = pd.read_json(io.BytesIO(obj.get()['Body'].read()))
-    df = pd.concat([df_word_freq, pd.DataFrame(df_word_freq_today)]).fillna(0)
-    json_buffer = io.StringIO()
-    df.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key=key, Body=json_buffer.getvalue())
-
-    key = 'df_emotion.json'
-    obj = s3.Object(BUCKET, key)
-    df = pd.read_json(io.BytesIO(obj.get()['Body'].read()))
-    df = pd.concat([df_emotion, pd.DataFrame(df_emotion_today)]).fillna(0)
-    json_buffer = io.StringIO()
-    df.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key=key, Body=json_buffer.getvalue())
\ No newline at end of file
+    #Append this week to the tables. Each table gets a partition for the week; apart from the manifest,
+    #nothing already stored is read or rewritten
+    tables = PartitionedTables(chart, BUCKET, s3)
+    tables.append({'df_final': df_final_today, 'df_artist_pop': df_artist_pop_today,
+                   'df_word_freq': df_word_freq_today, 'df_emotion': df_emotion_today})
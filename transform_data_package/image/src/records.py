@@ -0,0 +1,114 @@
+import json
+from typing import TypedDict, List, Optional, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+#Record definitions for the JSON the pipeline reads: chart files, Last.fm payloads, lyrics responses
+#and the raw weeks the transform works from. Only the fields something downstream uses are declared,
+#everything else (wiki text, tag and image URLs, artist bios) is dropped while parsing.
+#With msgspec installed the bytes are decoded straight into these shapes (as plain dicts, so nothing
+#downstream changes) and mistyped payloads are rejected. Without it they are parsed with plain json.loads
+#and keep every field: cutting them down in Python costs more than it saves, and readers only look up the
+#fields declared here anyway. Neither Lambda ships msgspec at the moment.
+#Both Lambdas use these: transform_data_package/image/src/records.py is a copy of this file, keep them the same
+class RecordError(ValueError):
+    pass
+
+#Last.fm sends counts as strings, but not everywhere
+Count = Union[int, str]
+
+class ChartEntry(TypedDict, total=False):
+    song: str
+    artist: str
+    album: str
+    this_week: int
+    last_week: Optional[int]
+    peak_position: int
+    weeks_on_chart: int
+
+class Chart(TypedDict):
+    date: str
+    data: List[ChartEntry]
+
+class Tag(TypedDict):
+    name: str
+
+class TagList(TypedDict, total=False):
+    tag: List[Tag]
+
+class Wiki(TypedDict, total=False):
+    summary: str
+
+class Track(TypedDict, total=False):
+    duration: Count
+    listeners: Count
+    playcount: Count
+    toptags: TagList
+    wiki: Wiki
+
+class TrackInfo(TypedDict, total=False):
+    track: Track
+    error: int
+    message: str
+
+class ArtistStats(TypedDict, total=False):
+    listeners: Count
+
+class SimilarArtist(TypedDict):
+    name: str
+
+class SimilarArtists(TypedDict, total=False):
+    artist: List[SimilarArtist]
+
+class Artist(TypedDict, total=False):
+    name: str
+    stats: ArtistStats
+    tags: TagList
+    similar: SimilarArtists
+
+class ArtistInfo(TypedDict, total=False):
+    artist: Artist
+    error: int
+    message: str
+
+class LyricsPayload(TypedDict, total=False):
+    lyrics: str
+
+#What the transform reads from a raw week. Writers must not use this, it drops the other enrichment fields
+class WeekEntry(TypedDict, total=False):
+    song: str
+    artist: str
+    this_week: int
+    peak_position: int
+    weeks_on_chart: int
+    duration: Count
+    toptags: TagList
+    lyrics: str
+    lyrics_sha256: str
+
+class Week(TypedDict):
+    date: str
+    data: List[WeekEntry]
+
+#The record type of a week's entries, for reading NDJSON weeks line by line
+def entry_record(week_record):
+    return week_record.__annotations__['data'].__args__[0]
+
+decoders = {}
+
+def decoder(record_type):
+    if record_type not in decoders:
+        decoders[record_type] = msgspec.json.Decoder(record_type)
+    return decoders[record_type]
+
+#Decode JSON bytes (or str) into record_type. Without a record type, or without msgspec, this is plain json.loads
+def decode(body, record_type=None):
+    if (record_type is None) or (msgspec is None):
+        return json.loads(body)
+    try:
+        return decoder(record_type).decode(body)
+    except msgspec.DecodeError as e:
+        raise RecordError(f"{record_type.__name__}: {e}") from e
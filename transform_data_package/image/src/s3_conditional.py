@@ -0,0 +1,49 @@
+import boto3
+import threading
+from botocore.exceptions import ClientError
+
+#Conditional S3 writes, used for the objects that several processes update (lake_manifest, table_store, enrich_cache).
+#PutObject only takes IfMatch/IfNoneMatch from botocore 1.35 on, and the vendored botocore (and whatever the
+#transform image and dashboard install) may be older, so the header is added just before the request is signed.
+#One client is shared by every write; the condition for the put in progress is kept per thread and the handler
+#only adds a header while one is set.
+#transform_data_package/image/src/s3_conditional.py and s3_conditional.py at the top of the repo are copies
+#of this file, keep them the same
+CONFLICT_CODES = ['412', 'PreconditionFailed', '409', 'ConditionalRequestConflict']
+
+class ConflictError(Exception):
+    pass
+
+_client = None
+_client_lock = threading.Lock()
+_condition = threading.local()
+
+def add_condition(request, **kwargs):
+    header = getattr(_condition, 'header', None)
+    if header is not None:
+        request.headers[header] = _condition.value
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.session.Session().client('s3')
+            _client.meta.events.register('before-sign.s3.PutObject', add_condition)
+        return _client
+
+def error_code(error):
+    return error.response.get('Error', {}).get('Code', '')
+
+#Writes body only if the object is still at `etag` (If-Match), or for etag=None doesn't exist yet
+#(If-None-Match: *). Raises ConflictError otherwise. Returns the new ETag
+def conditional_put(bucket, key, body, etag=None, content_type='application/json'):
+    client = get_client()
+    _condition.header, _condition.value = ('If-Match', etag) if etag else ('If-None-Match', '*')
+    try:
+        return client.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)['ETag']
+    except ClientError as e:
+        if error_code(e) in CONFLICT_CODES:
+            raise ConflictError(f"{key} changed since it was read") from e
+        raise
+    finally:
+        _condition.header = _condition.value = None
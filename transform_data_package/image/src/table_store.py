@@ -0,0 +1,254 @@
+import io
+import os
+import json
+import threading
+import boto3
+import pandas as pd
+from urllib.parse import quote
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_conditional import conditional_put, ConflictError, error_code
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+#The dashboard tables, stored as one partition per week per table instead of one JSON document per table
+#that is downloaded, appended to and uploaded again every week:
+#   tables/<chart>/<table>/<date>.parquet   one week of one table (LONG_TABLES have a row per key)
+#   tables/<chart>/manifest.json            every table's partitions: {table: {date: {format, rows, bytes}}}
+#Appending a week writes that week's partitions and the manifest, however long the history is, and writing
+#a week again replaces it. Readers get the dates from the manifest and fetch only the partitions they need.
+#Partitions are Parquet, or JSON where pyarrow isn't installed; readers handle both.
+#All reads and writes go through a TableStore: objects are cached on local disk with their ETag, a cached
+#partition whose ETag matches the manifest's is used without asking S3, and anything else cached is revalidated
+#with If-None-Match. Manifest updates are conditional on the ETag they were based on (see s3_conditional), so two
+#transforms appending at once retry instead of one silently dropping the other's week.
+#The dashboard uses a copy of this file (table_store.py at the top of the repo), keep them the same.
+#s3_conditional.py is shared with the pull side the same way
+BUCKET = 'what-are-we-singing-about'
+TABLES_PREFIX = 'tables/'
+TABLES = ['df_final', 'df_artist_pop', 'df_word_freq', 'df_emotion']
+PARTITION_FORMAT = 'parquet' if pyarrow else 'json'
+MAX_WORKERS = 16
+TABLE_CACHE_DIR = os.environ.get('TABLE_CACHE_DIR', '/tmp/tables')
+MANIFEST_RETRIES = 5
+NOT_MODIFIED_CODES = ['304', 'NotModified']
+
+#Artist popularity and word frequency are long tables: a (date, key, value) row for each artist or word
+#seen that week, rather than a column for every artist or word ever seen that is almost all zeros
+LONG_TABLES = ['df_artist_pop', 'df_word_freq']
+LONG_COLUMNS = ['date', 'key', 'value']
+
+#Long rows of a wide table (a column per key, 0 where the key didn't appear that week), without the zeros
+def to_long(df):
+    df = df.melt(id_vars='date', var_name='key', value_name='value', ignore_index=False)
+    return df[df['value'] != 0][LONG_COLUMNS]
+
+#A column for each of keys and a row for each week in a long table, 0 where a key wasn't there that week.
+#Only these keys are pivoted, so the result is as wide as what's plotted
+def pivot_long(df, keys):
+    wide = df[df['key'].isin(keys)].pivot_table(index='date', columns='key', values='value', aggfunc='sum')
+    return wide.reindex(index=sorted(df['date'].unique()), columns=list(keys)).fillna(0)
+
+def partition_date(value):
+    return str(pd.Timestamp(value).date())
+
+#Parquet columns hold one type, so lists and dicts (df_final keeps each week's songs as lists) are stored as JSON text
+def nested_columns(df):
+    return [column for column in df.columns if df[column].dtype == object and
+            df[column].map(lambda value: isinstance(value, (list, dict))).any()]
+
+def json_default(value):
+    return value.item() if hasattr(value, 'item') else str(value)
+
+#JSON partitions are written split (columns, index and rows listed separately), since the long tables have a row
+#per key and so repeat each week in their index. Ones written before that were a {column: {index: value}} document
+JSON_SPLIT_PREFIX = b'{"columns":'
+
+def encode_partition(df, partition_format):
+    if partition_format == 'json':
+        return df.to_json(orient='split', date_format='iso').encode('UTF-8'), []
+    df = df.copy()
+    columns = nested_columns(df)
+    for column in columns:
+        df[column] = df[column].map(lambda value: json.dumps(value, default=json_default))
+    buffer = io.BytesIO()
+    df.to_parquet(buffer)
+    return buffer.getvalue(), columns
+
+def decode_partition(body, partition_format, columns=()):
+    if partition_format == 'json':
+        return pd.read_json(io.BytesIO(body), orient='split' if body.startswith(JSON_SPLIT_PREFIX) else None)
+    df = pd.read_parquet(io.BytesIO(body))
+    for column in columns:
+        df[column] = df[column].map(json.loads)
+    return df
+
+class TableStore:
+
+    #cache_dir=None keeps the cache in memory only
+    def __init__(self, bucket=BUCKET, s3=None, cache_dir=TABLE_CACHE_DIR):
+        self.bucket = bucket
+        self.s3 = s3 or boto3.resource('s3')
+        self.cache_dir = cache_dir
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'revalidated': 0, 'fetched': 0, 'written': 0, 'conflicts': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, quote(key, safe=''))
+
+    def cached(self, key):
+        if self.cache_dir is None:
+            return self.memory.get(key, (None, None))
+        path = self.cache_path(key)
+        try:
+            with open(path + '.etag') as f:
+                etag = f.read()
+            with open(path, 'rb') as f:
+                return etag, f.read()
+        except FileNotFoundError:
+            return None, None
+
+    #The body goes in before its ETag, so a cached ETag always has the body it names
+    def cache(self, key, etag, body):
+        if self.cache_dir is None:
+            self.memory[key] = (etag, body)
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(key)
+        for name, data, mode in [(path, body, 'wb'), (path + '.etag', etag, 'w')]:
+            with open(name + '.tmp', mode) as f:
+                f.write(data)
+            os.replace(name + '.tmp', name)
+
+    #Returns (body, ETag), or (None, None) if there's no such object. A cached copy with the ETag `expected`
+    #is used as it is; any other cached copy is revalidated with If-None-Match
+    def get(self, key, expected=None):
+        etag, body = self.cached(key)
+        if (etag is not None) and (etag == expected):
+            self.count('hits')
+            return body, etag
+        try:
+            response = self.s3.Object(self.bucket, key).get(**({'IfNoneMatch': etag} if etag else {}))
+        except self.s3.meta.client.exceptions.NoSuchKey:
+            return None, None
+        except ClientError as e:
+            if error_code(e) in NOT_MODIFIED_CODES:
+                self.count('revalidated')
+                return body, etag
+            raise
+        body = response['Body'].read()
+        etag = response['ETag']
+        self.cache(key, etag, body)
+        self.count('fetched')
+        return body, etag
+
+    #With conditional, the write only happens if the object is still at `etag` (or, for etag=None, doesn't
+    #exist yet) and raises ConflictError otherwise. Returns the new ETag
+    def put(self, key, body, etag=None, conditional=True):
+        if conditional:
+            try:
+                etag = conditional_put(self.bucket, key, body, etag)
+            except ConflictError:
+                self.count('conflicts')
+                raise
+        else:
+            etag = self.s3.Object(self.bucket, key).put(Body=body)['ETag']
+        self.cache(key, etag, body)
+        self.count('written')
+        return etag
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+class PartitionedTables:
+
+    def __init__(self, chart, bucket=BUCKET, s3=None, max_workers=MAX_WORKERS, store=None):
+        self.chart = chart
+        self.store = store or TableStore(bucket, s3)
+        self.max_workers = max_workers
+        self.prefix = f"{TABLES_PREFIX}{chart}/"
+        self.manifest = None
+        self.manifest_etag = None
+
+    def manifest_key(self):
+        return self.prefix + 'manifest.json'
+
+    def partition_key(self, table, date, partition_format):
+        return f"{self.prefix}{table}/{date}.{partition_format}"
+
+    def load_manifest(self):
+        if self.manifest is None:
+            body, self.manifest_etag = self.store.get(self.manifest_key())
+            self.manifest = json.loads(body) if body else {'tables': {}}
+        return self.manifest
+
+    #The next read picks up weeks appended since the manifest was loaded
+    def refresh(self):
+        self.manifest = None
+
+    def save_manifest(self):
+        body = json.dumps(self.manifest, sort_keys=True).encode('UTF-8')
+        self.manifest_etag = self.store.put(self.manifest_key(), body, self.manifest_etag)
+
+    def dates(self, table):
+        return sorted(self.load_manifest()['tables'].get(table, {}))
+
+    def write_partition(self, table, date, df):
+        body, columns = encode_partition(df, PARTITION_FORMAT)
+        etag = self.store.put(self.partition_key(table, date, PARTITION_FORMAT), body, conditional=False)
+        partition = {'format': PARTITION_FORMAT, 'rows': len(df), 'bytes': len(body), 'etag': etag}
+        if columns:
+            partition['json_columns'] = columns
+        return partition
+
+    #Write every row of each frame as its week's partition, then record them all in one manifest update.
+    #frames is {table: DataFrame with a 'date' column}. If another writer updated the manifest in between,
+    #it is read again and the update reapplied
+    def append(self, frames):
+        written = []
+        for table, df in frames.items():
+            for date, rows in df.groupby(df['date'].map(partition_date), sort=True):
+                written.append((table, date, rows))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            partitions = list(executor.map(lambda item: self.write_partition(*item), written))
+
+        for attempt in range(MANIFEST_RETRIES):
+            manifest = self.load_manifest()
+            for (table, date, rows), partition in zip(written, partitions):
+                manifest['tables'].setdefault(table, {})[date] = partition
+            try:
+                self.save_manifest()
+                return len(written)
+            except ConflictError:
+                print(f"Manifest for {self.chart} changed while appending, retrying")
+                self.refresh()
+        raise ConflictError(f"Gave up updating the manifest for {self.chart} after {MANIFEST_RETRIES} attempts")
+
+    def read_partition(self, table, date):
+        partition = self.load_manifest()['tables'][table][date]
+        body, etag = self.store.get(self.partition_key(table, date, partition['format']), partition.get('etag', None))
+        return decode_partition(body, partition['format'], partition.get('json_columns', []))
+
+    #The table as one DataFrame, like the old whole-table JSON: dates parsed, missing values 0.
+    #start and end (YYYY-MM-DD, inclusive) limit which weeks are fetched
+    def read(self, table, start=None, end=None):
+        dates = [date for date in self.dates(table) if (start is None or date >= start) and (end is None or date <= end)]
+        if not dates:
+            return pd.DataFrame(columns=LONG_COLUMNS) if table in LONG_TABLES else pd.DataFrame()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            partitions = list(executor.map(lambda date: self.read_partition(table, date), dates))
+        df = pd.concat(partitions).fillna(0)
+        df.index = pd.to_datetime(df.index)
+        if 'date' in df.columns:
+            df['date'] = pd.to_datetime(df['date'])
+        return df
@@ -0,0 +1,115 @@
+import os
+import io
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+import replay
+import records
+from raw_lake import decode_raw_week
+from records import decode, Week, TrackInfo
+
+#Compare the dict path (json.loads of the whole document) with the typed decoding in records over a year
+#of data: raw weekly files as the transform reads them, and Last.fm track.getInfo payloads as the pull reads them.
+#Raw weeks come from a local copy of data/ (--weeks-dir) and Last.fm payloads from a cassette recorded with
+#benchmark_pull.py (--cassette); without them, a year of weeks shaped like the real ones is generated.
+#Reports the best time of REPEATS and how much memory the decoded year holds on to
+WEEKS = 52
+ENTRIES = 100
+REPEATS = 3
+TRANSFORM_RECORDS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'transform_data_package', 'image', 'src', 'records.py')
+
+def words(rng, n):
+    return ' '.join(rng.choice(['love', 'night', 'baby', 'heart', 'dance', 'feel', 'time', 'know']) for _ in range(n))
+
+def synthetic_track_info(rng, i):
+    tags = [{'name': f"tag {j}", 'url': f"https://www.last.fm/tag/tag+{j}"} for j in range(5)]
+    return {'track': {'name': f"Song {i}", 'mbid': '', 'url': f"https://www.last.fm/music/Artist+{i}/_/Song+{i}",
+                      'duration': str(rng.randint(120, 300)*1000), 'streamable': {'#text': '0', 'fulltrack': '0'},
+                      'listeners': str(rng.randint(1000, 2000000)), 'playcount': str(rng.randint(10000, 90000000)),
+                      'artist': {'name': f"Artist {i}", 'mbid': '', 'url': f"https://www.last.fm/music/Artist+{i}"},
+                      'album': {'artist': f"Artist {i}", 'title': f"Album {i}", 'url': f"https://www.last.fm/music/Artist+{i}/Album+{i}",
+                                'image': [{'#text': f"https://lastfm.freetls.fastly.net/i/u/{size}/{i}.png", 'size': size}
+                                          for size in ['small', 'medium', 'large', 'extralarge']]},
+                      'toptags': {'tag': tags},
+                      'wiki': {'published': '01 Jan 2020, 00:00', 'summary': words(rng, 60), 'content': words(rng, 600)}}}
+
+def synthetic_weeks(rng, n_weeks):
+    weeks = []
+    for week in range(n_weeks):
+        data = []
+        for position in range(1, ENTRIES + 1):
+            i = rng.randint(0, 3*ENTRIES)
+            track = synthetic_track_info(rng, i)['track']
+            data.append({'song': f"Song {i}", 'artist': f"Artist {i}", 'this_week': position, 'last_week': None,
+                         'peak_position': position, 'weeks_on_chart': rng.randint(1, 40),
+                         'duration': track['duration'], 'lastfm_listeners': track['listeners'],
+                         'lastfm_playcount': track['playcount'], 'toptags': track['toptags'],
+                         'summary': track['wiki']['summary'], 'lyrics': words(rng, 300),
+                         'artist_tags': ['pop', 'dance'], 'similar_artists': [f"Artist {i + 1}", f"Artist {i + 2}"]})
+        weeks.append(json.dumps({'date': f"week {week}", 'data': data}).encode('UTF-8'))
+    return weeks
+
+def load_weeks(weeks_dir, n_weeks):
+    names = sorted(name for name in os.listdir(weeks_dir) if name.endswith('.json'))[-n_weeks:]
+    weeks = []
+    for name in names:
+        with open(os.path.join(weeks_dir, name), 'rb') as f:
+            weeks.append(f.read())
+    return weeks
+
+def load_track_infos(cassette_dir):
+    cassette = replay.Cassette(cassette_dir)
+    return [cassette.load(key)['body'].encode('UTF-8') for key in cassette.keys() if 'method=track.getInfo' in key]
+
+def time_decode(bodies, decode_body, repeats=REPEATS):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for body in bodies:
+            decode_body(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    #Memory held by the decoded values, measured on a separate pass so tracing doesn't skew the timing
+    tracemalloc.start()
+    decoded = [decode_body(body) for body in bodies]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del decoded
+    return best, retained
+
+def compare(name, bodies, plain, typed):
+    n_bytes = sum(len(body) for body in bodies)
+    print(f"{name}: {len(bodies)} documents, {n_bytes/1e6:.1f} MB")
+    results = {'dict': time_decode(bodies, plain), 'typed': time_decode(bodies, typed)}
+    for path, (elapsed, retained) in results.items():
+        print(f"  {path:5s}  {1000*elapsed:8.1f} ms  {n_bytes/1e6/elapsed:7.1f} MB/s  {retained/1e6:7.1f} MB retained")
+    print(f"  typed/dict: {results['typed'][0]/results['dict'][0]:.2f}x time, "
+          f"{results['typed'][1]/results['dict'][1]:.2f}x memory")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark typed decoding (records.py) against plain json.loads')
+    parser.add_argument('--weeks-dir', default=None, help='directory of raw weekly files, e.g. a local copy of data/')
+    parser.add_argument('--cassette', default=None, help='cassette recorded with benchmark_pull.py record')
+    parser.add_argument('--weeks', type=int, default=WEEKS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Decoder: {'msgspec ' + records.msgspec.__version__ if records.msgspec else 'json (msgspec not installed)'}")
+    with open(records.__file__, 'rb') as a, open(TRANSFORM_RECORDS, 'rb') as b:
+        if a.read() != b.read():
+            print(f"Warning: {TRANSFORM_RECORDS} differs from {records.__file__}")
+
+    rng = random.Random(args.seed)
+    weeks = load_weeks(args.weeks_dir, args.weeks) if args.weeks_dir else synthetic_weeks(rng, args.weeks)
+    track_infos = load_track_infos(args.cassette) if args.cassette else \
+        [json.dumps(synthetic_track_info(rng, i)).encode('UTF-8') for i in range(args.weeks*ENTRIES)]
+
+    #Weeks go through raw_lake so compressed NDJSON weeks are read the way the pipeline reads them
+    compare('Raw weeks', weeks, lambda body: decode_raw_week(io.BytesIO(body)),
+            lambda body: decode_raw_week(io.BytesIO(body), record=Week))
+    compare('Last.fm track.getInfo', track_infos, json.loads, lambda body: decode(body, TrackInfo))
@@ -0,0 +1,117 @@
+import re
+import json
+import time
+import argparse
+import threading
+
+import http_client
+import replay
+from normalize import memo
+from lyrics_providers import reset_fetcher
+from enrich import enrich_sequential, enrich_concurrent
+from lambda_function import HOT_100_HISTORIC_BASE
+from mock_upstream import serve_in_background
+
+#Offline benchmark of the pull path. `record` captures real responses for some weeks into a cassette,
+#`run` replays them through a local mock upstream and reports weeks/minute and per-request latency
+#for each enrichment strategy.
+STRATEGIES = {'sequential': lambda entries: enrich_sequential(entries),
+              'concurrent': lambda entries: enrich_concurrent(entries)}
+
+def chart_url(date_string):
+    return HOT_100_HISTORIC_BASE + date_string + '.json'
+
+def record(cassette_dir, dates):
+    observer = replay.start_recording(cassette_dir)
+    try:
+        for date_string in dates:
+            hot_100 = http_client.get(chart_url(date_string)).json()
+            enrich_concurrent(hot_100['data'])
+    finally:
+        replay.stop_recording(observer)
+
+def cassette_dates(cassette_dir):
+    dates = []
+    for key in replay.Cassette(cassette_dir).keys():
+        match = re.search(r'/date/(\d{4}-\d{2}-\d{2})\.json$', key)
+        if match:
+            dates.append(match.group(1))
+    return sorted(dates)
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q/100*(len(values) - 1))))]
+
+#Each strategy starts cold: no pooled connections, no remembered query variants and no hedge latency history
+#left over from the strategy before it
+def reset_caches():
+    http_client.reset_clients()
+    memo.reset()
+    reset_fetcher()
+
+def run_strategy(name, dates):
+    latencies = {}
+    lock = threading.Lock()
+
+    def observer(upstream, url, response, error, elapsed):
+        with lock:
+            latencies.setdefault(upstream, []).append(elapsed)
+
+    reset_caches()
+    http_client.observers.append(observer)
+    start = time.perf_counter()
+    try:
+        for date_string in dates:
+            hot_100 = http_client.get(chart_url(date_string)).json()
+            STRATEGIES[name](hot_100['data'])
+    finally:
+        http_client.observers.remove(observer)
+    elapsed = time.perf_counter() - start
+
+    result = {'strategy': name, 'weeks': len(dates), 'seconds': round(elapsed, 2),
+              'weeks_per_minute': round(60*len(dates)/elapsed, 2), 'upstreams': {}}
+    all_latencies = []
+    for upstream, values in sorted(latencies.items()):
+        all_latencies += values
+        result['upstreams'][upstream] = {'requests': len(values),
+                                         'p50_ms': round(1000*percentile(values, 50), 1),
+                                         'p99_ms': round(1000*percentile(values, 99), 1)}
+    result['p50_ms'] = round(1000*percentile(all_latencies, 50), 1)
+    result['p99_ms'] = round(1000*percentile(all_latencies, 99), 1)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record or benchmark the pull path offline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='capture live responses for some weeks')
+    record_parser.add_argument('cassette_dir')
+    record_parser.add_argument('dates', nargs='+')
+
+    run_parser = subparsers.add_parser('run', help='replay a cassette and time each strategy')
+    run_parser.add_argument('cassette_dir')
+    run_parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES))
+    run_parser.add_argument('--latency', type=float, default=0.05)
+    run_parser.add_argument('--jitter', type=float, default=0.02)
+    run_parser.add_argument('--error-rate', type=float, default=0.)
+    run_parser.add_argument('--burst-every', type=int, default=0)
+    run_parser.add_argument('--burst-length', type=int, default=0)
+    run_parser.add_argument('--no-rate-limit', action='store_true', help='lift the per-upstream token buckets')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.cassette_dir, args.dates)
+    else:
+        if args.no_rate_limit:
+            for config in http_client.UPSTREAMS.values():
+                config['rate'] = config['burst'] = 10000
+        server = serve_in_background(args.cassette_dir, port=0, latency=args.latency, jitter=args.jitter,
+                                     error_rate=args.error_rate, burst_every=args.burst_every,
+                                     burst_length=args.burst_length, seed=0)
+        replay.start_replay(server.base_url)
+        dates = cassette_dates(args.cassette_dir)
+        for name in args.strategies:
+            print(json.dumps(run_strategy(name, dates)))
+        server.shutdown()
@@ -0,0 +1,96 @@
+import os
+import sys
+import shutil
+import zipfile
+import argparse
+import compileall
+
+#Build the pull Lambda's deployment zip. By default the vendored dependencies are copied as they are;
+#with --minimal the bundle is cut down to what the pull path actually loads:
+#botocore and boto3 model data only for the services it calls, the newest API version of each,
+#no dist-info, console scripts, tests or stale bytecode. Everything is then precompiled, because
+#/var/task is read-only and Lambda can't cache bytecode itself.
+#Check the result with utilities/measure_cold_start.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PULL_DIR = os.path.join(ROOT, 'pull_data')
+DEPENDENCIES_DIR = os.path.join(PULL_DIR, 'dependencies')
+BUILD_DIR = os.path.join(ROOT, 'build', 'pull_data')
+ZIP_PATH = os.path.join(ROOT, 'build', 'pull_data.zip')
+
+#S3 for the lake, Lambda for fanning shards out
+KEEP_SERVICES = ['s3', 'lambda']
+
+#requests needs charset_normalizer, idna, urllib3 and certifi; botocore needs dateutil (and six) and jmespath
+KEEP_PACKAGES = ['boto3', 'botocore', 's3transfer', 'requests', 'urllib3', 'certifi', 'charset_normalizer',
+                 'idna', 'dateutil', 'jmespath', 'six.py']
+PRUNED_NAMES = ['__pycache__', 'tests', 'examples']
+
+def copy_sources(build_dir):
+    for name in sorted(os.listdir(PULL_DIR)):
+        if name.endswith('.py'):
+            shutil.copy2(os.path.join(PULL_DIR, name), build_dir)
+    if not os.path.exists(os.path.join(PULL_DIR, 'secret_stuff.py')):
+        print('Warning: pull_data/secret_stuff.py not found, the bundle has no Last.fm API key')
+
+def copy_dependencies(build_dir, minimal):
+    for name in sorted(os.listdir(DEPENDENCIES_DIR)):
+        source = os.path.join(DEPENDENCIES_DIR, name)
+        if minimal and (name not in KEEP_PACKAGES):
+            continue
+        if os.path.isdir(source):
+            ignore = shutil.ignore_patterns(*PRUNED_NAMES, '*.pyc') if minimal else None
+            shutil.copytree(source, os.path.join(build_dir, name), ignore=ignore)
+        else:
+            shutil.copy2(source, build_dir)
+
+#Drop model data for services the pull path never creates a client or resource for
+def prune_service_data(build_dir, keep_services=KEEP_SERVICES):
+    for package in ['botocore', 'boto3']:
+        data_dir = os.path.join(build_dir, package, 'data')
+        for name in sorted(os.listdir(data_dir)):
+            path = os.path.join(data_dir, name)
+            if not os.path.isdir(path):
+                continue
+            if name not in keep_services:
+                shutil.rmtree(path)
+                continue
+
+            #Only the newest API version of a service is ever loaded
+            versions = sorted(os.listdir(path))
+            for version in versions[:-1]:
+                shutil.rmtree(os.path.join(path, version))
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name)) for directory, _, names in os.walk(path) for name in names)
+
+def write_zip(build_dir, zip_path):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for directory, _, names in os.walk(build_dir):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                bundle.write(path, os.path.relpath(path, build_dir))
+
+def build(minimal=False, build_dir=BUILD_DIR, zip_path=ZIP_PATH, keep_services=KEEP_SERVICES):
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    copy_sources(build_dir)
+    copy_dependencies(build_dir, minimal)
+    if minimal:
+        prune_service_data(build_dir, keep_services)
+
+    #Bytecode is only valid for the interpreter it was compiled with, which must match the Lambda runtime
+    compileall.compile_dir(build_dir, quiet=1, invalidation_mode=compileall.py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    write_zip(build_dir, zip_path)
+    print(f"Built {zip_path} from {build_dir}: {directory_size(build_dir)/1e6:.1f} MB unpacked, "
+          f"{os.path.getsize(zip_path)/1e6:.1f} MB zipped (Python {sys.version_info.major}.{sys.version_info.minor} bytecode)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the pull Lambda deployment zip')
+    parser.add_argument('--minimal', action='store_true', help='prune unused packages and AWS service data')
+    parser.add_argument('--build-dir', default=BUILD_DIR)
+    parser.add_argument('--zip-path', default=ZIP_PATH)
+    parser.add_argument('--keep-service', action='append', default=None,
+                        help=f"AWS service whose model data is kept (default: {', '.join(KEEP_SERVICES)})")
+    args = parser.parse_args()
+    build(args.minimal, args.build_dir, args.zip_path, args.keep_service or KEEP_SERVICES)
@@ -0,0 +1,47 @@
+import sys
+import argparse
+import pandas as pd
+
+from table_store import encode_partition, decode_partition, PARTITION_FORMAT, LONG_COLUMNS
+
+#Round-trip one week of each kind of table through the partition encoding and check it comes back the same:
+#a long table (a row per key, so the week repeats in the index), df_final with its list columns, and a wide
+#table. JSON is always checked since it is what runs without pyarrow; Parquet is checked when pyarrow is
+#installed. Exits non-zero on any difference
+DATE = '2024-01-06 00:00:00'
+
+def sample_tables():
+    long = pd.DataFrame({'date': [DATE]*3, 'key': ['Artist A', 'Artist B', 'Artist C'], 'value': [3., 2., 1.]},
+                        index=[DATE]*3)[LONG_COLUMNS]
+    final = pd.DataFrame({'date': [DATE], 'songs': [['Song A', 'Song B']], 'n_songs': [2], 'mean_duration': [201.5]},
+                         index=[DATE])
+    wide = pd.DataFrame({'date': [DATE], 'joy': [0.25], 'fear': [0.1]}, index=[DATE])
+    return {'long': long, 'df_final': final, 'wide': wide}
+
+#Indexes and dates are parsed the way PartitionedTables.read parses them
+def normalize(df):
+    df = df.copy()
+    df.index = pd.to_datetime(df.index)
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+def round_trip(df, partition_format):
+    body, columns = encode_partition(df, partition_format)
+    return decode_partition(body, partition_format, columns)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that table partitions survive encoding and decoding')
+    parser.parse_args()
+
+    formats = ['json'] + (['parquet'] if PARTITION_FORMAT == 'parquet' else [])
+    failed = []
+    for partition_format in formats:
+        for name, df in sample_tables().items():
+            try:
+                pd.testing.assert_frame_equal(normalize(round_trip(df, partition_format)), normalize(df), check_dtype=False)
+                print(f"{partition_format:8s} {name:10s} ok")
+            except Exception as e:
+                print(f"{partition_format:8s} {name:10s} FAILED: {e!r}")
+                failed.append((partition_format, name))
+    if failed:
+        sys.exit(1)
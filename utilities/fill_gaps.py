@@ -0,0 +1,119 @@
+import argparse
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+from enrich import enrich_unique, apply_fields
+from enrich_cache import EnrichmentCache, S3CacheStore, normalize_key
+from raw_lake import load_raw_week, write_raw_week, FORMAT_METADATA
+from chart_state import parse_raw_week_key
+from charts import CHARTS, DEFAULT_CHART
+from lake_manifest import lake_manifest, batch
+from lyrics_store import LyricsBlobStore, externalize_lyrics, uses_blobs, LYRICS_HASH_FIELD
+
+#Re-enrich songs whose Last.fm metadata or lyrics are missing from the raw weekly files.
+#Every (artist, song) is looked up once no matter how many weeks it charted, then every
+#affected week is patched and written back in one pass.
+BUCKET = 'what-are-we-singing-about'
+MAX_WORKERS = 16
+
+#Raw week keys for one chart, or for every chart when chart is None, optionally between two dates (inclusive).
+#They come from the lake manifest; until reconcile_lake.py has made it complete, data/ is listed
+def list_raw_keys(bucket=BUCKET, chart=DEFAULT_CHART, start=None, end=None):
+    keys = lake_manifest(bucket).keys(chart, start, end)
+    if keys is not None:
+        return keys
+    print('No complete lake manifest yet, listing data/ (run utilities/reconcile_lake.py to build one)')
+    client = boto3.client('s3')
+    keys = []
+    prefix = 'data/' if chart is None else f"data/{chart}-"
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for object_info in page.get('Contents', []):
+            week = parse_raw_week_key(object_info['Key'])
+            if (week is not None) and ((chart is None) or (week[0] == chart)) and \
+               ((start is None) or (week[1] >= start)) and ((end is None) or (week[1] <= end)):
+                keys.append(object_info['Key'])
+    return keys
+
+def load_week(key, bucket=BUCKET):
+    return load_raw_week(key, bucket)
+
+def missing_sources(entry):
+    missing = []
+    unenriched = entry.get('unenriched', [])
+    if ('duration' not in entry) or ('track' in unenriched):
+        missing.append('track')
+    if (('lyrics' not in entry) and (LYRICS_HASH_FIELD not in entry)) or ('lyrics' in unenriched):
+        missing.append('lyrics')
+    return missing
+
+#Returns {normalized key: {'entry': first entry seen, 'missing': set of sources}}
+def find_gaps(weeks):
+    gaps = {}
+    for hot_100, metadata in weeks.values():
+        for entry in hot_100['data']:
+            missing = missing_sources(entry)
+            if missing:
+                gap = gaps.setdefault(normalize_key(entry['artist'], entry['song']), {'entry': entry, 'missing': set()})
+                gap['missing'].update(missing)
+    return gaps
+
+def fill_gaps(gaps, cache=None, max_workers=MAX_WORKERS):
+    wanted = {key: (gap['entry'], sorted(gap['missing'])) for key, gap in gaps.items()}
+    results = {}
+    for key, found in enrich_unique(wanted, max_workers, cache).items():
+        for source, fields in found.items():
+            if fields:
+                results.setdefault(key, {})[source] = fields
+    return results
+
+#Apply the new fields to every entry that was missing them. Returns True if the week changed
+def patch_week(hot_100, results):
+    changed = False
+    for entry in hot_100['data']:
+        found = results.get(normalize_key(entry['artist'], entry['song']), {})
+        for source in missing_sources(entry):
+            if source in found:
+                apply_fields(entry, found[source], source)
+                if source in entry.get('unenriched', []):
+                    entry['unenriched'].remove(source)
+                    if not entry['unenriched']:
+                        del entry['unenriched']
+                changed = True
+    return changed
+
+#Weeks are written back in the format they were read in, lyrics included
+def write_week(key, hot_100, metadata, bucket=BUCKET, lyrics_store=None):
+    if uses_blobs(hot_100['data']):
+        externalize_lyrics(hot_100['data'], lyrics_store or LyricsBlobStore(bucket))
+    chart, date = parse_raw_week_key(key)
+    write_raw_week(hot_100, metadata, metadata.get(FORMAT_METADATA, 'json'), bucket, chart)
+
+def run(dry_run=False, max_workers=MAX_WORKERS, chart=DEFAULT_CHART):
+    keys = list_raw_keys(BUCKET, chart)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        weeks = dict(zip(keys, executor.map(load_week, keys)))
+
+    gaps = find_gaps(weeks)
+    n_lookups = sum(len(gap['missing']) for gap in gaps.values())
+    print(f"Scanned {len(weeks)} weeks, {len(gaps)} unique songs have gaps ({n_lookups} lookups)")
+    if dry_run or not gaps:
+        return
+
+    cache = EnrichmentCache(S3CacheStore(BUCKET))
+    results = fill_gaps(gaps, cache, max_workers)
+    cache.save()
+    print(f"Filled {sum(len(found) for found in results.values())} of {n_lookups} lookups")
+
+    changed = [key for key, (hot_100, metadata) in weeks.items() if patch_week(hot_100, results)]
+    lyrics_store = LyricsBlobStore(BUCKET)
+    with batch(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda key: write_week(key, *weeks[key], lyrics_store=lyrics_store), changed))
+    print(f"Patched {len(changed)} weekly files")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-enrich songs missing lyrics or metadata across all raw weeks')
+    parser.add_argument('--dry-run', action='store_true', help='only report the gaps')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--chart', default=DEFAULT_CHART, choices=list(CHARTS))
+    args = parser.parse_args()
+    run(args.dry_run, args.max_workers, args.chart)
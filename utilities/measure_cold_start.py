@@ -0,0 +1,64 @@
+import os
+import re
+import sys
+import tempfile
+import argparse
+import subprocess
+from statistics import median
+
+from build_pull_bundle import BUILD_DIR
+
+#Measure how long a fresh interpreter takes to import the pull Lambda's handler module from a built bundle,
+#which is the part of a cold start the bundle controls. Each run is a new process so nothing is cached
+#in memory; the median over RUNS is compared to IMPORT_BUDGET_MS and the script exits non-zero when over
+IMPORT_BUDGET_MS = 250
+RUNS = 5
+HANDLER_MODULE = 'lambda_function'
+TOP_MODULES = 15
+
+#secret_stuff.py isn't in the repo. If the bundle was built without it, a placeholder is put on the path
+#so the import can be measured
+def placeholder_secrets(bundle_dir, directory):
+    if os.path.exists(os.path.join(bundle_dir, 'secret_stuff.py')):
+        return []
+    with open(os.path.join(directory, 'secret_stuff.py'), 'w') as f:
+        f.write("LASTFM_API_KEY = ''\n")
+    return [directory]
+
+#Returns the wall time of the import in ms and {module: cumulative import time in ms}
+def measure_once(bundle_dir, extra_paths):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([bundle_dir] + extra_paths), PYTHONDONTWRITEBYTECODE='1')
+    code = f"import time; start = time.perf_counter(); import {HANDLER_MODULE}; print((time.perf_counter() - start)*1000)"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True, text=True, check=True)
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match:
+            modules[match.group(3)] = int(match.group(1))/1000
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+def measure(bundle_dir, runs=RUNS):
+    with tempfile.TemporaryDirectory() as directory:
+        extra_paths = placeholder_secrets(bundle_dir, directory)
+        results = [measure_once(bundle_dir, extra_paths) for _ in range(runs)]
+    return [elapsed for elapsed, modules in results], results[-1][1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the import time of a built pull Lambda bundle against a budget')
+    parser.add_argument('bundle_dir', nargs='?', default=BUILD_DIR, help='unpacked bundle, see build_pull_bundle.py')
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=RUNS)
+    args = parser.parse_args()
+
+    timings, modules = measure(args.bundle_dir, args.runs)
+    print("Slowest imports (ms, cumulative):")
+    for name, elapsed in sorted(modules.items(), key=lambda item: -item[1])[:TOP_MODULES]:
+        print(f"  {elapsed:8.1f}  {name}")
+
+    import_ms = median(timings)
+    print(f"Import of {HANDLER_MODULE}: median {import_ms:.1f} ms over {len(timings)} runs "
+          f"(min {min(timings):.1f}, max {max(timings):.1f}), budget {args.budget_ms:.0f} ms")
+    if import_ms > args.budget_ms:
+        print('Over budget')
+        sys.exit(1)
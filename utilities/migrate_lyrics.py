@@ -0,0 +1,48 @@
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from fill_gaps import list_raw_keys
+from raw_lake import load_raw_week, write_raw_week, FORMAT_METADATA
+from chart_state import parse_raw_week_key
+from lyrics_store import LyricsBlobStore, externalize_lyrics
+from lake_manifest import batch
+
+#Move the lyrics embedded in the raw weekly files into the content-addressed blob store (lyrics/<sha256>),
+#leaving only the hash in each entry. Weeks are rewritten in the format they were read in, with their
+#metadata kept. Weeks with no inline lyrics are left alone, so the migration can be re-run after an interruption
+BUCKET = 'what-are-we-singing-about'
+MAX_WORKERS = 16
+
+def inline_bytes(hot_100):
+    return sum(len(entry['lyrics'].encode('UTF-8')) for entry in hot_100['data'] if 'lyrics' in entry)
+
+def migrate_week(key, store, dry_run=False):
+    hot_100, metadata = load_raw_week(key, BUCKET)
+    n_bytes = inline_bytes(hot_100)
+    if (n_bytes == 0) or dry_run:
+        return n_bytes, 0
+    n_entries = externalize_lyrics(hot_100['data'], store, max_workers=1)
+    chart, date = parse_raw_week_key(key)
+    write_raw_week(hot_100, metadata, metadata.get(FORMAT_METADATA, 'json'), BUCKET, chart)
+    return n_bytes, n_entries
+
+def run(dry_run=False, max_workers=MAX_WORKERS):
+    store = LyricsBlobStore(BUCKET)
+    store.load_known()
+    keys = list_raw_keys(BUCKET, chart=None)
+    with batch(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda key: migrate_week(key, store, dry_run), keys))
+
+    n_bytes = sum(n_bytes for n_bytes, n_entries in results)
+    n_weeks = len([n_bytes for n_bytes, n_entries in results if n_bytes])
+    print(f"{n_weeks} of {len(keys)} weeks embed lyrics ({n_bytes/1e6:.1f} MB inline)")
+    if not dry_run:
+        print(f"Moved lyrics out of {sum(n_entries for n_bytes, n_entries in results)} entries: {json.dumps(store.stats())}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move lyrics out of the raw weekly files into the lyric blob store')
+    parser.add_argument('--dry-run', action='store_true', help='only report how much lyric text is inline')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS)
+    args = parser.parse_args()
+    run(args.dry_run, args.max_workers)
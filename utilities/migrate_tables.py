@@ -0,0 +1,59 @@
+import io
+import argparse
+import boto3
+import pandas as pd
+
+from charts import CHARTS, DEFAULT_CHART
+from table_store import PartitionedTables, TABLES, LONG_TABLES, to_long, partition_date
+
+#Split the old whole-table JSON documents (<table>.json for the Hot 100, <chart>/<table>.json for other charts)
+#into weekly partitions under tables/<chart>/, and rewrite wide partitions of the long tables (artist popularity,
+#word frequency) as long ones. Weeks already in the manifest are written again, so this can be re-run.
+#The old documents are left where they are
+BUCKET = 'what-are-we-singing-about'
+
+def legacy_table_key(table, chart):
+    if chart == DEFAULT_CHART:
+        return f"{table}.json"
+    return f"{chart}/{table}.json"
+
+#Partitions written before the long tables were introduced have a column per key
+def wide_partitions(tables, table):
+    partitions = [tables.read_partition(table, date) for date in tables.dates(table)]
+    partitions = [df for df in partitions if 'key' not in df.columns]
+    return pd.concat(partitions).fillna(0) if partitions else None
+
+def migrate_chart(chart, s3, dry_run=False):
+    tables = PartitionedTables(chart, BUCKET, s3)
+    frames = {}
+    for table in TABLES:
+        try:
+            body = s3.Object(BUCKET, legacy_table_key(table, chart)).get()['Body'].read()
+            frames[table] = pd.read_json(io.BytesIO(body))
+            print(f"{chart} {table}: {len(frames[table])} weeks, {len(frames[table].columns)} columns, {len(body)/1e6:.1f} MB")
+        except s3.meta.client.exceptions.NoSuchKey:
+            pass
+        if table in LONG_TABLES:
+            wide = wide_partitions(tables, table)
+            if wide is not None:
+                print(f"{chart} {table}: {len(wide)} wide partitions")
+                if table in frames:
+                    #Weeks the transform already partitioned are newer than the old document's copy
+                    legacy = frames[table]
+                    legacy = legacy[~legacy['date'].map(partition_date).isin(set(wide['date'].map(partition_date)))]
+                    wide = pd.concat([legacy, wide])
+                frames[table] = wide
+            if table in frames:
+                frames[table] = to_long(frames[table].fillna(0))
+    if frames and not dry_run:
+        n_partitions = tables.append(frames)
+        print(f"{chart}: wrote {n_partitions} partitions")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Split the whole-table JSON documents into weekly partitions')
+    parser.add_argument('--chart', action='append', default=None, help=f"chart to migrate (default: all of {', '.join(CHARTS)})")
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be migrated')
+    args = parser.parse_args()
+    s3 = boto3.resource('s3')
+    for chart in args.chart or list(CHARTS):
+        migrate_chart(chart, s3, args.dry_run)
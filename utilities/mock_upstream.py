@@ -0,0 +1,120 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from replay import Cassette, cassette_key
+
+#Local stand-in for GitHub raw, Last.fm and lyrist that replays a recorded cassette.
+#Requests arrive as /<original host><original path>, which is what http_client sends when REDIRECT_BASE is set.
+DEFAULT_PORT = 8765
+
+class MockUpstream(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    #latency and jitter are in seconds. error_rate is the fraction of requests answered with a 503.
+    #Every burst_every requests, the next burst_length requests get a 429 with Retry-After.
+    def __init__(self, cassette_dir, port=DEFAULT_PORT, latency=0.05, jitter=0.02, error_rate=0.,
+                 burst_every=0, burst_length=0, retry_after=1, seed=None):
+        super().__init__(('127.0.0.1', port), MockUpstreamHandler)
+        self.cassette = Cassette(cassette_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.counts = {'replayed': 0, 'missing': 0, 'errors': 0, 'throttled': 0, 'not_modified': 0}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    #Decide up front how this request will be answered: 'throttle', 'error' or 'replay'
+    def next_outcome(self):
+        with self.lock:
+            self.n_requests += 1
+            if self.burst_every and (self.n_requests % self.burst_every < self.burst_length):
+                return 'throttle', 0.
+            delay = max(0., self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.random.random() < self.error_rate:
+                return 'error', delay
+            return 'replay', delay
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+
+    #Keep connections alive like the real upstreams do, so pooled sessions are exercised
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        outcome, delay = self.server.next_outcome()
+        time.sleep(delay)
+        if outcome == 'throttle':
+            self.server.count('throttled')
+            self.respond(429, {'Retry-After': str(self.server.retry_after)}, '{"error": 29, "message": "Rate Limit Exceeded"}')
+            return
+        if outcome == 'error':
+            self.server.count('errors')
+            self.respond(503, {}, '{"error": 16, "message": "Service temporarily unavailable"}')
+            return
+
+        record = self.server.cassette.load(cassette_key('http:/' + self.path))
+        if record is None:
+            self.server.count('missing')
+            self.respond(404, {}, '{"error": "not in cassette"}')
+            return
+        etag = record['headers'].get('ETag', None)
+        if etag and (self.headers.get('If-None-Match', None) == etag):
+            self.server.count('not_modified')
+            self.respond(304, {'ETag': etag}, '')
+            return
+        self.server.count('replayed')
+        self.respond(record['status'], record['headers'], record['body'])
+
+    def respond(self, status, headers, body):
+        body = body.encode('UTF-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Type' not in headers:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_in_background(cassette_dir, **kwargs):
+    server = MockUpstream(cassette_dir, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a recorded cassette as a local upstream server')
+    parser.add_argument('cassette_dir')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--burst-every', type=int, default=0)
+    parser.add_argument('--burst-length', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockUpstream(args.cassette_dir, port=args.port, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, burst_every=args.burst_every, burst_length=args.burst_length)
+    print(f"Replaying {args.cassette_dir} on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.counts))
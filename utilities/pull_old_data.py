@@ -1,12 +1,26 @@
+import os
+import re
 import numpy as np
 import json
-import requests
 import boto3
-import io
+import tarfile
 from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from lambda_function import pull_data
+import http_client
+from lambda_function import pull_data, fetch_historic_chart, upload_raw_week
+from chart_state import chart_hash
+from charts import DEFAULT_CHART
+from enrich import unique_songs, enrich_unique, apply_fields
+from artists import enrich_artists
+from enrich_cache import EnrichmentCache, LocalCacheStore, S3CacheStore, normalize_key
+from fill_gaps import list_raw_keys
+from raw_lake import load_raw_week
+from lake_manifest import batch
+from records import Week
+from lyrics_store import LyricsBlobStore, resolve_lyrics, LYRICS_BLOBS
 from extract_features import make_df, calc_confidence_wings, extract_features
+from table_store import PartitionedTables
 
 BUCKET = 'what-are-we-singing-about'
 HOT_100_HISTORIC_BASE = 'https://raw.githubusercontent.com/mhollingshead/billboard-hot-100/main/date/'
@@ -14,42 +28,186 @@ VALID_DATES_URL = 'https://raw.githubusercontent.com/mhollingshead/billboard-hot
 
 date_start = '2020-01-01'
 
-def pull_old_data(date_start):
-    valid_dates = requests.get(VALID_DATES_URL).json()
+#Backfills share one enrichment cache across weeks so each song is only looked up once.
+#Set CACHE_PATH to keep the cache on local disk instead of in the bucket
+CACHE_PATH = None
+CACHE_SAVE_EVERY = 10
+VALID_DATES_CACHE_PATH = '.http_cache/valid_dates.json'
 
-    for date_valid in valid_dates:
-        if date.fromisoformat(date_valid) > date.fromisoformat(date_start):
-            pull_data(date_string=date_valid)
+#Weeks are pulled by WEEK_WORKERS threads. They all go through the same http_client token buckets,
+#so together they stay inside each upstream's rate limit. Completed dates are checkpointed so an
+#interrupted backfill picks up where it left off
+WEEK_WORKERS = 4
+DEDUP_WORKERS = 16
+CHECKPOINT_PATH = '.backfill_checkpoint.json'
+ARCHIVE_BATCH_WEEKS = 250
+ARCHIVE_CHART_PATTERN = r'(\d{4}-\d{2}-\d{2})\.json'
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f))
+
+def save_checkpoint(completed, path=CHECKPOINT_PATH):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(sorted(completed), f)
+    os.replace(path + '.tmp', path)
+
+def existing_raw_dates():
+    return {re.search(r'(\d{4}-\d{2}-\d{2})', key).group(1) for key in list_raw_keys(BUCKET)}
+
+def open_cache():
+    if CACHE_PATH:
+        return EnrichmentCache(LocalCacheStore(CACHE_PATH))
+    return EnrichmentCache(S3CacheStore(BUCKET))
+
+#Valid dates after date_start, minus weeks completed by an earlier run or already in the lake
+def dates_to_pull(date_start, completed):
+    valid_dates = http_client.get_json_cached(VALID_DATES_URL, VALID_DATES_CACHE_PATH)
+    done = completed | existing_raw_dates()
+    return [date_valid for date_valid in valid_dates
+            if (date.fromisoformat(date_valid) > date.fromisoformat(date_start)) and (date_valid not in done)]
+
+def pull_old_data(date_start, week_workers=WEEK_WORKERS):
+    cache = open_cache()
+    lyrics_store = LyricsBlobStore(BUCKET) if LYRICS_BLOBS else None
+    completed = load_checkpoint()
+    todo = dates_to_pull(date_start, completed)
+    print(f"Backfilling {len(todo)} weeks with {week_workers} workers")
+
+    n_weeks = 0
+    with batch(), ThreadPoolExecutor(max_workers=week_workers) as executor:
+        futures = {executor.submit(pull_data, date_string=date_valid, cache=cache, lyrics_store=lyrics_store): date_valid for date_valid in todo}
+        for future in as_completed(futures):
+            date_valid = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to pull {date_valid}, it will be retried on the next run: {e!r}")
+                continue
+
+            completed.add(date_valid)
+            save_checkpoint(completed)
+            n_weeks += 1
+            if (n_weeks % CACHE_SAVE_EVERY == 0):
+                cache.save()
+    cache.save()
+
+#Enrich each unique (artist, song) across the given weeks once, then fan the results back out
+#into the per-week raw files. charts is {date: (hot_100, content_hash)}
+def enrich_and_upload(charts, cache, completed, max_workers=DEDUP_WORKERS, lyrics_store=None):
+    entries = [entry for hot_100, content_hash in charts.values() for entry in hot_100['data']]
+    songs = unique_songs(entries)
+    if songs:
+        print(f"Backfilling {len(charts)} weeks: {len(entries)} entries, {len(songs)} unique songs "
+              f"(dedup ratio {len(entries)/len(songs):.1f}x, {2*len(songs)} lookups instead of {2*len(entries)})")
+
+    results = enrich_unique({key: (entry, ['track', 'lyrics']) for key, entry in songs.items()}, max_workers, cache)
+    for entry in entries:
+        found = results[normalize_key(entry['artist'], entry['song'])]
+        apply_fields(entry, found['track'], 'track')
+        apply_fields(entry, found['lyrics'], 'lyrics')
+    enrich_artists(entries, cache, max_workers=max_workers)
+    cache.save()
+
+    def upload(date_valid):
+        upload_raw_week(*charts[date_valid], lyrics_store=lyrics_store)
+
+    with batch(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload, date_valid): date_valid for date_valid in charts}
+        for future in as_completed(futures):
+            date_valid = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to upload {date_valid}, it will be retried on the next run: {e!r}")
+                continue
+            completed.add(date_valid)
+    save_checkpoint(completed)
+
+#Deduplicated backfill in three phases: fetch every chart in the range, enrich each unique
+#(artist, song) once, then fan the results back out into the per-week raw files
+def pull_old_data_dedup(date_start, max_workers=DEDUP_WORKERS):
+    cache = open_cache()
+    completed = load_checkpoint()
+    todo = dates_to_pull(date_start, completed)
+
+    #A chart that fails to download is left out of this run and the checkpoint, so the next run retries it
+    charts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_historic_chart, date_valid): date_valid for date_valid in todo}
+        for future in as_completed(futures):
+            date_valid = futures[future]
+            try:
+                charts[date_valid] = future.result()
+            except Exception as e:
+                print(f"Failed to fetch {date_valid}, it will be retried on the next run: {e!r}")
+    charts = dict(sorted(charts.items()))
+
+    enrich_and_upload(charts, cache, completed, max_workers, LyricsBlobStore(BUCKET) if LYRICS_BLOBS else None)
+
+#Charts from a local copy of the billboard-hot-100 dataset instead of one download per week: either a
+#checkout (a directory containing date/<date>.json) or a tarball of one, such as GitHub's source archive.
+#Tarballs are read as a stream, so the archive is never unpacked. Yields (date, hot_100, content_hash)
+def iter_archive_charts(archive_path):
+    if os.path.isdir(archive_path):
+        for directory, _, names in sorted(os.walk(archive_path)):
+            for name in sorted(names):
+                match = re.fullmatch(ARCHIVE_CHART_PATTERN, name)
+                if match and (os.path.basename(directory) == 'date'):
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        body = f.read()
+                    yield match.group(1), json.loads(body), chart_hash(body)
+        return
+
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for member in archive:
+            match = re.fullmatch(ARCHIVE_CHART_PATTERN, os.path.basename(member.name))
+            if member.isfile() and match and (os.path.basename(os.path.dirname(member.name)) == 'date'):
+                body = archive.extractfile(member).read()
+                yield match.group(1), json.loads(body), chart_hash(body)
+
+#Bulk backfill from a dataset archive. Weeks after date_start that aren't in the lake or the checkpoint
+#are collected in batches of ARCHIVE_BATCH_WEEKS as the archive is read, and each batch goes through
+#the same deduplicated enrichment as pull_old_data_dedup. The shared cache means songs that chart in
+#several batches are still only looked up once, and each finished batch is checkpointed
+def pull_old_data_archive(archive_path, date_start, max_workers=DEDUP_WORKERS, batch_weeks=ARCHIVE_BATCH_WEEKS):
+    cache = open_cache()
+    lyrics_store = LyricsBlobStore(BUCKET) if LYRICS_BLOBS else None
+    completed = load_checkpoint()
+    done = completed | existing_raw_dates()
+
+    charts = {}
+    n_weeks = 0
+    for date_valid, hot_100, content_hash in iter_archive_charts(archive_path):
+        if (date.fromisoformat(date_valid) <= date.fromisoformat(date_start)) or (date_valid in done):
+            continue
+        charts[date_valid] = (hot_100, content_hash)
+        if len(charts) == batch_weeks:
+            enrich_and_upload(charts, cache, completed, max_workers, lyrics_store)
+            n_weeks += len(charts)
+            charts = {}
+    if charts:
+        enrich_and_upload(charts, cache, completed, max_workers, lyrics_store)
+        n_weeks += len(charts)
+    print(f"Backfilled {n_weeks} weeks from {archive_path}")
 
 if __name__ == "__main__":
     #pull_old_data(date_start)
+    #pull_old_data_archive('billboard-hot-100-main.tar.gz', date_start)
 
     s3 = boto3.resource('s3')
-    client = boto3.client('s3')
-    all_objects = client.list_objects_v2(Bucket=BUCKET, Prefix='data/')
+    lyrics_store = LyricsBlobStore(BUCKET)
     hot_100_all = {}
-    for object_info in all_objects['Contents']:
-        if ".json" in object_info['Key']:
-            print(object_info['Key'])
-            obj = s3.Object(BUCKET, object_info['Key'])
-            hot_100 = json.loads(obj.get()['Body'].read().decode('UTF-8'))
-            hot_100_product = make_df(hot_100)
-            hot_100_all[hot_100_product['date']] = hot_100_product
+    for key in list_raw_keys(BUCKET, DEFAULT_CHART):
+        print(key)
+        hot_100, metadata = load_raw_week(key, BUCKET, Week)
+        resolve_lyrics(hot_100['data'], lyrics_store)
+        hot_100_product = make_df(hot_100)
+        hot_100_all[hot_100_product['date']] = hot_100_product
 
     df_final, df_artist_pop, df_word_freq, df_emotion = extract_features(hot_100_all)
 
-    json_buffer = io.StringIO()
-    df_final.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key='df_final.json', Body=json_buffer.getvalue())
-
-    json_buffer = io.StringIO()
-    df_artist_pop.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key='df_artist_pop.json', Body=json_buffer.getvalue())
-
-    json_buffer = io.StringIO()
-    df_word_freq.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key='df_word_freq.json', Body=json_buffer.getvalue())
-
-    json_buffer = io.StringIO()
-    df_emotion.to_json(json_buffer)
-    s3.Bucket(BUCKET).put_object(Key='df_emotion.json', Body=json_buffer.getvalue())
\ No newline at end of file
+    tables = PartitionedTables(DEFAULT_CHART, BUCKET, s3)
+    tables.append({'df_final': df_final, 'df_artist_pop': df_artist_pop, 'df_word_freq': df_word_freq, 'df_emotion': df_emotion})
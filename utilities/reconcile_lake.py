@@ -0,0 +1,80 @@
+import io
+import hashlib
+import argparse
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+from chart_state import parse_raw_week_key
+from raw_lake import decode_raw_week, FORMAT_METADATA, SHA256_METADATA, COUNT_METADATA
+from lake_manifest import lake_manifest, week_record
+
+#Rebuild the lake manifest (pull_data/lake_manifest.py) from a paginated listing of data/, and mark it complete
+#so readers use it instead of listing. Weeks whose size and ETag match their manifest record are left alone.
+#The rest are described again: NDJSON weeks from their metadata (a HEAD), JSON weeks by reading them.
+#Records of keys that are gone are dropped.
+#With --list, prints the manifest's weeks for a chart and date range instead, which takes one GET
+BUCKET = 'what-are-we-singing-about'
+MAX_WORKERS = 16
+
+#{key: (size, ETag)} for every raw week in the bucket
+def list_raw_objects(bucket=BUCKET):
+    client = boto3.client('s3')
+    objects = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix='data/'):
+        for object_info in page.get('Contents', []):
+            if parse_raw_week_key(object_info['Key']) is not None:
+                objects[object_info['Key']] = (object_info['Size'], object_info.get('ETag', None))
+    return objects
+
+def describe_week(key, size, etag, bucket=BUCKET):
+    metadata = boto3.client('s3').head_object(Bucket=bucket, Key=key).get('Metadata', {})
+    if (SHA256_METADATA in metadata) and (COUNT_METADATA in metadata):
+        return week_record(key, metadata.get(FORMAT_METADATA, 'json'), size, metadata[SHA256_METADATA], int(metadata[COUNT_METADATA]), etag)
+
+    s3 = boto3.resource('s3')
+    body = s3.Object(bucket, key).get()['Body'].read()
+    hot_100 = decode_raw_week(io.BytesIO(body), metadata)
+    return week_record(key, metadata.get(FORMAT_METADATA, 'json'), size, hashlib.sha256(body).hexdigest(), len(hot_100['data']), etag)
+
+def run(dry_run=False, max_workers=MAX_WORKERS):
+    objects = list_raw_objects(BUCKET)
+    manifest = lake_manifest(BUCKET)
+    recorded = manifest.weeks(chart=None, incomplete=True) or {}
+    stale = [key for key, (size, etag) in objects.items()
+             if (key not in recorded) or (recorded[key]['size'] != size) or (recorded[key]['etag'] != etag)]
+    removed = [key for key in recorded if key not in objects]
+    print(f"{len(objects)} raw weeks in the bucket, {len(recorded)} in the manifest: "
+          f"{len(stale)} to describe, {len(removed)} to drop")
+    if dry_run or not (stale or removed or not manifest.complete()):
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        described = dict(zip(stale, executor.map(lambda key: describe_week(key, *objects[key]), stale)))
+
+    #Only keys this run looked at are touched, so weeks written while it ran aren't lost
+    def change(weeks):
+        for key in removed:
+            weeks.pop(key, None)
+        weeks.update(described)
+
+    manifest.update(change, complete=True)
+    print(f"Recorded {len(described)} weeks, dropped {len(removed)}, the manifest is complete")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rebuild the lake manifest from a listing of data/, or query it')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would change')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--list', action='store_true', help='print the weeks in the manifest instead')
+    parser.add_argument('--chart', default=None, help='with --list, only this chart')
+    parser.add_argument('--start', default=None, help='with --list, first date (YYYY-MM-DD)')
+    parser.add_argument('--end', default=None, help='with --list, last date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    if args.list:
+        weeks = lake_manifest(BUCKET).weeks(args.chart, args.start, args.end)
+        if weeks is None:
+            print('No complete lake manifest yet, run without --list to build one')
+        for key, record in (weeks or {}).items():
+            print(f"{record['date']}  {record['chart']:15s} {record['entries']:4d} entries {record['size']/1e3:9.1f} kB  {record['format']:12s} {key}")
+    else:
+        run(args.dry_run, args.max_workers)
@@ -0,0 +1,44 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+
+from lambda_function import fetch_historic_chart
+from shards import split_shards, run_shards_local, load_partials, merge_shards, LocalShardStore
+from mock_upstream import serve_in_background
+import http_client
+
+#Exercise sharded enrichment on one machine: one process per shard, partial results in a local
+#directory, then the same merge the Lambda coordinator does. With --replay it runs fully offline
+#against a recorded cassette (see benchmark_pull.py)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run sharded enrichment for one week with a local process pool')
+    parser.add_argument('date')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--out-dir', default=None)
+    parser.add_argument('--replay', metavar='CASSETTE_DIR', default=None)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--use-cache', action='store_true', help='read the shared S3 enrichment cache')
+    args = parser.parse_args()
+
+    redirect_base = None
+    if args.replay:
+        server = serve_in_background(args.replay, port=0, latency=args.latency, seed=0)
+        redirect_base = server.base_url
+        http_client.REDIRECT_BASE = redirect_base
+    out_dir = args.out_dir or tempfile.mkdtemp(prefix='shards-')
+
+    for n_shards in args.shards:
+        hot_100, content_hash = fetch_historic_chart(args.date)
+        store = LocalShardStore(os.path.join(out_dir, f"{n_shards}-shards"))
+
+        start = time.perf_counter()
+        run_shards_local(split_shards(hot_100, n_shards), store, use_cache=args.use_cache, redirect_base=redirect_base)
+        merge_shards(hot_100, load_partials(store, hot_100['date'], n_shards))
+        elapsed = time.perf_counter() - start
+
+        path = os.path.join(store.directory, f"hot-100-{hot_100['date']}.json")
+        with open(path, 'w') as f:
+            json.dump(hot_100, f)
+        print(json.dumps({'shards': n_shards, 'seconds': round(elapsed, 2), 'entries': len(hot_100['data']), 'output': path}))